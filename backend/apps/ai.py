@@ -1,17 +1,106 @@
 from google import genai
+import asyncio
+import hashlib
 import os
 from datetime import datetime, timedelta
 from .events import get_user_events
 from .email import get_user_emails
+from .classify import JUNK_CATEGORIES, category_filter
+from .context import build_context
+from .db import ai_cache, ai_cache_stats, emails, calendars, users, get_sync_cursors, set_sync_cursor, TimelineNode
+from bson import ObjectId
 from logging import getLogger
 import json
+from pydantic import TypeAdapter, ValidationError
 
 # Configure logging
 logger = getLogger(__name__)
 
-async def generate_ai_response(context: str, query: str):
-    """Generate a response from Gemini AI model based on context and query."""
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Maximum number of Gemini calls in flight per process
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+# Only send activity that is new since the last run to the model
+AI_INCREMENTAL_NODES = os.getenv("AI_INCREMENTAL_NODES", "false").lower() == "true"
+WATERMARK_PREFIX = "ai_nodes:"
+# Watermark for a kind with nothing folded in yet: every stored item is newer
+MIN_WATERMARK = "0" * 24
+# Extra model calls allowed to fix a response that fails schema validation
+AI_MAX_REPAIR_ATTEMPTS = int(os.getenv("AI_MAX_REPAIR_ATTEMPTS", "1"))
+# Summarize the whole history week by week, then build nodes from the summaries
+AI_MAP_REDUCE_NODES = os.getenv("AI_MAP_REDUCE_NODES", "false").lower() == "true"
+AI_MAP_REDUCE_CONCURRENCY = int(os.getenv("AI_MAP_REDUCE_CONCURRENCY", "8"))
+AI_BUCKET_TOKEN_BUDGET = int(os.getenv("AI_BUCKET_TOKEN_BUDGET", "8000"))
+AI_BUCKET_MAX_ITEMS = 200
+
+_client: genai.Client | None = None
+_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+# The single ai_cache_stats document, shared by the API server and all workers
+CACHE_STATS_ID = "ai_cache"
+
+def get_genai_client() -> genai.Client:
+    """Return the process-wide Gemini client, creating it on first use"""
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _client
+
+class NodeGenerationError(Exception):
+    """Raised when the model can't produce valid nodes; stored nodes must be left untouched"""
+
+def prompt_cache_key(model: str, query: str, context: str, response_schema=None) -> str:
+    """Content address of a prompt: hash of the model, prompt template, context hash and output schema"""
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    schema = json.dumps(TypeAdapter(response_schema).json_schema(), sort_keys=True) if response_schema else None
+    hash_input = json.dumps([model, query, context_hash, schema])
+    return hashlib.sha256(hash_input.encode("utf-8")).hexdigest()
+
+async def get_cached_response(key: str) -> str | None:
+    """
+    Look up a cached AI response by prompt hash, counting hits and misses.
+    A hit restarts the entry's TTL, so responses still in use (like summaries of
+    unchanged weeks) are only evicted once nothing has asked for them in a while.
+    """
+    cached = await ai_cache.find_one_and_update(
+        {"key": key},
+        {"$set": {"created_at": datetime.utcnow()}},
+        projection={"response": 1}
+    )
+    await ai_cache_stats.update_one(
+        {"_id": CACHE_STATS_ID},
+        {"$inc": {"hits" if cached else "misses": 1}},
+        upsert=True
+    )
+    return cached["response"] if cached else None
+
+async def get_cache_stats() -> dict:
+    """AI response cache hit/miss counters across all processes"""
+    stats = await ai_cache_stats.find_one({"_id": CACHE_STATS_ID}) or {}
+    return {"hits": stats.get("hits", 0), "misses": stats.get("misses", 0)}
+
+async def set_cached_response(key: str, response: str):
+    """Store an AI response under its prompt hash (evicted by the TTL index once unused)"""
+    await ai_cache.update_one(
+        {"key": key},
+        {"$set": {"response": response, "model": GEMINI_MODEL, "created_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def generate_ai_response(context: str, query: str, use_cache: bool = True, response_schema=None):
+    """
+    Generate a response from Gemini AI model based on context and query.
+    Responses are cached in MongoDB by prompt hash, so an identical prompt
+    is answered without a model call until the cache entry goes unused for the TTL.
+    With a response_schema (a pydantic type) the model is constrained to JSON
+    matching it, and only responses that validate are cached.
+    """
+    key = prompt_cache_key(GEMINI_MODEL, query, context, response_schema)
+    if use_cache:
+        cached = await get_cached_response(key)
+        if cached is not None:
+            return cached
+
+    client = get_genai_client()
     prompt = f"""
         {query}
 
@@ -19,23 +108,55 @@ async def generate_ai_response(context: str, query: str):
 
         {context}
     """
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt,
-    )
-    return response.candidates[0].content.parts[0].text
+    # Use the SDK's async surface so the event loop keeps serving other requests
+    async with _semaphore:
+        response = await client.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": response_schema
+            } if response_schema else None,
+        )
+    text = response.candidates[0].content.parts[0].text
 
-async def generate_nodes(current_user):
+    if response_schema:
+        try:
+            TypeAdapter(response_schema).validate_json(text)
+        except ValidationError:
+            # Hand it back for repair, but never cache it
+            return text
+    if use_cache:
+        await set_cached_response(key, text)
+    return text
+
+REPAIR_PROMPT = """
+        The JSON below was supposed to match the required schema but failed validation. Return the corrected JSON only, keeping the content the same wherever possible.
+        """
+
+async def generate_structured(context: str, query: str, response_schema):
     """
-    Generate a list of nodes based on user's emails and calendar events.
-    Returns a simple list of nodes with no complex relationships.
+    Generate a response constrained to response_schema and return it validated.
+    Invalid output gets up to AI_MAX_REPAIR_ATTEMPTS repair calls before
+    NodeGenerationError is raised.
     """
-    try:
-        # Get existing nodes from user
-        existing_nodes = current_user.get("nodes_tmp", [])
-        
-        # Define the prompt for generating nodes
-        prompt = """
+    adapter = TypeAdapter(response_schema)
+    text = await generate_ai_response(context, query, response_schema=response_schema)
+    for attempt in range(AI_MAX_REPAIR_ATTEMPTS + 1):
+        try:
+            return adapter.validate_json(text)
+        except ValidationError as e:
+            logger.warning(f"Invalid structured AI response (attempt {attempt + 1}): {e.error_count()} errors")
+            if attempt == AI_MAX_REPAIR_ATTEMPTS:
+                raise NodeGenerationError(f"AI response failed validation: {e}") from e
+            text = await generate_ai_response(
+                f"Validation errors:\n{e}\n\nInvalid JSON:\n{text}",
+                REPAIR_PROMPT,
+                use_cache=False,
+                response_schema=response_schema
+            )
+
+NODES_PROMPT = """
         Generate a list of nodes of large life events based on user's emails and calendar events. This structure represents progress over time for a person and the important big events.
         Returns a simple list of nodes with no complex relationships. Each element of the array/list is a json object which has name, long_description, date !!! IMPORTANT DATE MEANS DATE OF EVENT/EMAIL/ACTIVITY/LIFE MOMENT, like when email was sent/event occured!!!, and sequential id (index), placed in cronological order of event date. 
         Name should be 3 words max (24 chars max)
@@ -43,83 +164,256 @@ async def generate_nodes(current_user):
         There will be lots of junk and spam emails/non important emails, ignore them, and try and add about 1-2 per week
 
         IMPORTANT: You should include all the existing nodes you would like the user to maintain, this is basically a personal diary, in your output, and add any new nodes based on recent activity. Although feel free to combine nodes (stay <15ish total) Here are the existing nodes:
-        """ + json.dumps(existing_nodes, indent=2)
+        """
 
-        # Get user's events and emails for the last 30 days
-        now = datetime.utcnow()
-        start_date = now - timedelta(days=30)
-        
-        logger.info(f"Fetching data for user: {current_user}")
-        
-        # Get events
-        try:
-            events_result = await get_user_events(
-                current_user=current_user,
-                start_date=start_date,
-                limit=100
-            )
-        except Exception as e:
-            logger.error(f"Error fetching events: {e}")
-            events_result = {"events": []}
+def build_nodes_prompt(existing_nodes: list) -> str:
+    """Build the node generation prompt around the user's existing nodes"""
+    return NODES_PROMPT + json.dumps(existing_nodes, indent=2)
+
+INCREMENTAL_NODES_PROMPT = """
+        You maintain a timeline of large life events for a user, built from their emails and calendar events. Below is new activity since the timeline was last updated.
+        Return ONLY new nodes for significant life events in this new activity, as a json array. Each element is a json object which has name, long_description, date !!! IMPORTANT DATE MEANS DATE OF EVENT/EMAIL/ACTIVITY/LIFE MOMENT, like when email was sent/event occured!!!
+        Name should be 3 words max (24 chars max)
+
+        There will be lots of junk and spam emails/non important emails, ignore them. Do not repeat events already on the timeline. If nothing is significant, return [].
+
+        Here is a summary of the existing timeline:
+        """
+
+def build_incremental_prompt(existing_nodes: list) -> str:
+    """Build the incremental prompt around a compact (name and date only) summary of existing nodes"""
+    summary = [{"name": node.get("name"), "date": node.get("date")} for node in existing_nodes if isinstance(node, dict)]
+    return INCREMENTAL_NODES_PROMPT + json.dumps(summary)
+
+async def generate_node_list(context: str, query: str) -> list:
+    """Ask the model for nodes as schema-constrained JSON and return them as plain dicts"""
+    nodes = await generate_structured(context, query, list[TimelineNode])
+    return [node.model_dump() for node in nodes]
+
+async def fetch_sources(current_user: dict, watermark: dict | None = None) -> tuple[list, list]:
+    """
+    Get the events and emails to build nodes from: the last 30 days of activity,
+    or with a watermark only items stored since it, oldest-inserted first.
+    A kind missing from the watermark is read from its first stored item.
+    """
+    watermark = watermark or {}
+    now = datetime.utcnow()
+    start_date = now - timedelta(days=30)
+
+    # Get events
+    try:
+        events_result = await get_user_events(
+            current_user=current_user,
+            start_date=None if watermark else start_date,
+            limit=100,
+            inserted_after=watermark.get("calendars", MIN_WATERMARK) if watermark else None
+        )
+    except Exception as e:
+        logger.error(f"Error fetching events: {e}")
+        events_result = {"events": []}
+    
+    # Get emails
+    try:
+        emails_result = await get_user_emails(
+            current_user=current_user,
+            limit=100,
+            inserted_after=watermark.get("emails", MIN_WATERMARK) if watermark else None,
+            exclude_categories=JUNK_CATEGORIES
+        )
+    except Exception as e:
+        logger.error(f"Error fetching emails: {e}")
+        emails_result = {"emails": []}
+
+    return events_result.get("events", []), emails_result.get("emails", [])
+
+async def latest_source_ids(user_id: str) -> dict:
+    """IDs of the newest stored email and event, used as the watermark after a full run"""
+    watermark = {}
+    for kind, collection in (("emails", emails), ("calendars", calendars)):
+        latest = await collection.find_one({"user_id": user_id}, {"_id": 1}, sort=[("_id", -1)])
+        if latest:
+            watermark[kind] = str(latest["_id"])
+    return watermark
+
+async def get_watermark(user_id: str) -> dict:
+    """The newest email and event already folded into the user's nodes"""
+    cursors = await get_sync_cursors(user_id, WATERMARK_PREFIX)
+    return {kind.removeprefix(WATERMARK_PREFIX): cursor for kind, cursor in cursors.items()}
+
+async def set_watermark(user_id: str, watermark: dict):
+    """Record the newest email and event folded into the user's nodes"""
+    for kind, source_id in watermark.items():
+        await set_sync_cursor(user_id, f"{WATERMARK_PREFIX}{kind}", source_id)
+
+def merge_nodes(existing_nodes: list, new_nodes: list) -> list:
+    """Append new nodes to the timeline in date order and renumber the sequential ids"""
+    merged = [node for node in existing_nodes + new_nodes if isinstance(node, dict)]
+    merged.sort(key=lambda node: str(node.get("date", "")))
+    for index, node in enumerate(merged):
+        node["id"] = index
+    return merged
+
+async def generate_nodes_incremental(current_user: dict, watermark: dict) -> tuple[list, dict]:
+    """
+    Fold only emails and events stored since the watermark into the existing nodes.
+    Returns the nodes and the advanced watermark, which the caller stores with save_nodes.
+    """
+    user_id = str(current_user["_id"])
+    existing_nodes = current_user.get("nodes_tmp", [])
+
+    events, emails_list = await fetch_sources(current_user, watermark)
+    if not events and not emails_list:
+        logger.info(f"No new activity for user {user_id}, keeping existing nodes")
+        return existing_nodes, watermark
+
+    # Unranked, the context holds the oldest new items that fit the budget; the rest wait for the next run
+    context, kept = build_context(events, emails_list, ranked=False)
+    new_nodes = await generate_node_list(context, build_incremental_prompt(existing_nodes))
+
+    # Sources come back oldest-inserted first, so the last kept ones are the new watermark
+    watermark = dict(watermark)
+    if kept["events"]:
+        watermark["calendars"] = str(events[kept["events"][-1]]["_id"])
+    if kept["emails"]:
+        watermark["emails"] = str(emails_list[kept["emails"][-1]]["_id"])
+
+    logger.info(f"Incremental update for user {user_id}: {len(new_nodes)} new nodes from {len(kept['events'])} of {len(events)} events, {len(kept['emails'])} of {len(emails_list)} emails")
+    return merge_nodes(existing_nodes, new_nodes), watermark
+
+WEEK_SUMMARY_PROMPT = """
+        Summarize one week of a user's emails and calendar events. List the significant things that happened in their life this week as short bullet points, each starting with its date.
+        There will be lots of junk and spam emails/non important emails, ignore them. If nothing significant happened, reply with exactly: NOTHING
+        """
+
+def week_start(moment: datetime) -> datetime:
+    """Midnight on the Monday of the moment's week"""
+    return datetime.combine((moment - timedelta(days=moment.weekday())).date(), datetime.min.time())
+
+async def list_activity_weeks(user_id: str) -> list:
+    """Start of every week that has non-junk emails or events, reading only the dates"""
+    weeks = set()
+    async for email in emails.find(
+        {"user_id": user_id, "category": category_filter(JUNK_CATEGORIES)},
+        {"datetime": 1, "_id": 0}
+    ):
+        if email.get("datetime"):
+            weeks.add(week_start(email["datetime"]))
+    async for event in calendars.find({"user_id": user_id}, {"datetime_start": 1, "_id": 0}):
+        if event.get("datetime_start"):
+            weeks.add(week_start(event["datetime_start"]))
+    return sorted(weeks)
+
+async def summarize_week(user_id: str, start: datetime) -> str:
+    """
+    Summarize one week of activity. The summary is cached by the hash of the
+    week's rendered content, so only weeks whose data changed call the model.
+    """
+    end = start + timedelta(days=7)
+    emails_list = await emails.find({
+        "user_id": user_id,
+        "category": category_filter(JUNK_CATEGORIES),
+        "datetime": {"$gte": start, "$lt": end}
+    }).sort("datetime", 1).to_list(AI_BUCKET_MAX_ITEMS)
+    events = await calendars.find({
+        "user_id": user_id,
+        "datetime_start": {"$gte": start, "$lt": end}
+    }).sort("datetime_start", 1).to_list(AI_BUCKET_MAX_ITEMS)
+
+    context, _ = build_context(events, emails_list, token_budget=AI_BUCKET_TOKEN_BUDGET)
+    return (await generate_ai_response(context, WEEK_SUMMARY_PROMPT)).strip()
+
+async def summarize_history(user_id: str) -> str:
+    """Map step: summarize every week of the user's history in parallel, as reduce-step context"""
+    weeks = await list_activity_weeks(user_id)
+    semaphore = asyncio.Semaphore(AI_MAP_REDUCE_CONCURRENCY)
+
+    async def summarize(start):
+        async with semaphore:
+            return await summarize_week(user_id, start)
+
+    # Let every week finish so the successful summaries are cached for the retry
+    summaries = await asyncio.gather(*(summarize(start) for start in weeks), return_exceptions=True)
+
+    failed = 0
+    for start, summary in zip(weeks, summaries):
+        if isinstance(summary, Exception):
+            logger.error(f"Error summarizing week of {start.date()} for user {user_id}: {summary}")
+            failed += 1
+    # Nodes built without a week would drop its events from the timeline
+    if failed:
+        raise NodeGenerationError(f"Could not summarize {failed} of {len(weeks)} weeks")
+
+    context = "Weekly summaries of the user's emails and calendar events:\n\n"
+    for start, summary in zip(weeks, summaries):
+        if summary and summary != "NOTHING":
+            context += f"Week of {start.date()}:\n{summary}\n\n"
+    logger.info(f"Summarized {len(weeks)} weeks for user {user_id}")
+    return context
+
+async def generate_nodes(
+    current_user,
+    incremental: bool = AI_INCREMENTAL_NODES,
+    map_reduce: bool = AI_MAP_REDUCE_NODES
+):
+    """
+    Generate a list of nodes based on user's emails and calendar events.
+    Returns a simple list of nodes with no complex relationships.
+    In incremental mode, once the user has nodes, only activity stored since the
+    last run is sent to the model along with a compact summary of existing nodes.
+    In map-reduce mode the whole history is summarized week by week and the
+    nodes are built from those summaries instead of the latest raw items.
+    Returns the nodes and the watermark of the newest sources they cover. The
+    watermark must only be stored once the nodes are (see save_nodes), or the
+    next incremental run would skip activity that never reached the timeline.
+    Raises NodeGenerationError instead of returning an empty list on failure,
+    so callers never overwrite stored nodes with a failed generation.
+    """
+    try:
+        user_id = str(current_user["_id"])
+        # Get existing nodes from user
+        existing_nodes = current_user.get("nodes_tmp", [])
+
+        if incremental and existing_nodes:
+            watermark = await get_watermark(user_id)
+            if watermark:
+                return await generate_nodes_incremental(current_user, watermark)
         
-        # Get emails
-        try:
-            emails_result = await get_user_emails(
-                current_user=current_user,
-                limit=100
-            )
-        except Exception as e:
-            logger.error(f"Error fetching emails: {e}")
-            emails_result = {"emails": []}
-
-        # Build context with events
-        context = "Recent calendar events:\n"
-        if events_result and isinstance(events_result, dict) and "events" in events_result and events_result["events"]:
-            for event in events_result["events"]:
-                context += f"Event: {event.get('event_name', 'Untitled')}\n"
-                context += f"Date: {event.get('datetime_start')}\n"
-                context += f"Description: {event.get('description', 'No description')}\n"
-                if event.get('location'):
-                    context += f"Location: {event['location']}\n"
-                if event.get('collaborators'):
-                    context += f"Collaborators: {', '.join(event['collaborators'])}\n"
-                context += "\n"
-        else:
-            context += "No recent calendar events found.\n\n"
+        # Define the prompt for generating nodes
+        prompt = build_nodes_prompt(existing_nodes)
         
-        # Add emails to context
-        context += "Recent emails:\n"
-        if emails_result and isinstance(emails_result, dict) and "emails" in emails_result and emails_result["emails"]:
-            for email in emails_result["emails"]:
-                context += f"From: {email.get('sender', 'Unknown')}\n"
-                context += f"Subject: {email.get('subject', 'No subject')}\n"
-                context += f"Date: {email.get('datetime')}\n"
-                context += f"Content: {email.get('content', 'No content')}\n\n"
+        logger.info(f"Fetching data for user: {user_id}")
+        # Read the watermark first so items stored mid-run are picked up next time
+        watermark = await latest_source_ids(user_id)
+        if map_reduce:
+            context = await summarize_history(user_id)
         else:
-            context += "No recent emails found.\n"
-
+            events, emails_list = await fetch_sources(current_user)
+            context, _ = build_context(events, emails_list)
 
         # Generate AI response with the context
-        response = await generate_ai_response(context, prompt)
-        
-        # Parse the response as JSON
-        try:
-   
-            # Find first [ and last ] to extract JSON array
-            start_idx = response.find('[')
-            end_idx = response.rfind(']')
-            if start_idx != -1 and end_idx != -1:
-                response = response[start_idx:end_idx + 1]
-            print(response)
-            nodes = json.loads(response)
-           
-            if isinstance(nodes, list):
-                return nodes
-            return []
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse AI response as JSON: {e}")
-            return []
+        nodes = await generate_node_list(context, prompt)
+        if not nodes and existing_nodes:
+            # The full prompt asks for existing nodes back, so an empty list would wipe the timeline
+            raise NodeGenerationError("AI returned no nodes")
+
+        # These nodes become the user's existing nodes, so regenerating from the
+        # same sources should be a cache hit rather than another model call
+        await set_cached_response(
+            prompt_cache_key(GEMINI_MODEL, build_nodes_prompt(nodes), context, list[TimelineNode]),
+            json.dumps(nodes)
+        )
+        return nodes, watermark
             
+    except NodeGenerationError:
+        raise
     except Exception as e:
         logger.error(f"Error in generate_nodes: {e}")
-        return []
+        raise NodeGenerationError(str(e)) from e
+
+async def save_nodes(user_id: str, nodes: list, watermark: dict):
+    """Store generated nodes as the user's timeline, then advance the watermark past their sources"""
+    await users.update_one(
+        {"_id": ObjectId(user_id)},
+        {"$set": {"nodes_tmp": nodes}}
+    )
+    await set_watermark(user_id, watermark)
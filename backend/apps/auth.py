@@ -2,8 +2,10 @@ from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from bson import ObjectId
 import os
+import time
 from .db import users, User
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -13,6 +15,15 @@ JWT_SECRET = os.getenv("JWT_SECRET", os.getenv("GOOGLE_CLIENT_SECRET"))
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_MINUTES = 60 * 24  # 24 hours
 
+# In-process cache of user records for request authentication
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+# Large or secret fields left out of cached user records; load them with load_user_fields
+HEAVY_USER_FIELDS = ("nodes_tmp", "google_data", "google_refresh_token")
+
+# user_id -> (expires_at, slim user dict), least recently used first
+_user_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=JWT_EXPIRATION_MINUTES)
@@ -20,13 +31,40 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+def invalidate_user(user_id: str):
+    """Drop a cached user record after the user document changes"""
+    _user_cache.pop(str(user_id), None)
+
+async def load_user(user_id: str) -> dict | None:
+    """
+    The user's record without its heavy fields, from the cache when fresh.
+    Other processes (worker, scheduler) also write users, so entries expire
+    after USER_CACHE_TTL_SECONDS even without an explicit invalidation.
+    """
+    now = time.monotonic()
+    cached = _user_cache.get(user_id)
+    if cached and cached[0] > now:
+        _user_cache.move_to_end(user_id)
+        return dict(cached[1])
+
+    user = await users.find_one({"_id": ObjectId(user_id)}, {field: 0 for field in HEAVY_USER_FIELDS})
+    if not user:
+        _user_cache.pop(user_id, None)
+        return None
+    user["_id"] = str(user["_id"])  # Convert ObjectId to string
+
+    _user_cache[user_id] = (now + USER_CACHE_TTL_SECONDS, user)
+    _user_cache.move_to_end(user_id)
+    while len(_user_cache) > USER_CACHE_MAX_ENTRIES:
+        _user_cache.popitem(last=False)
+    return dict(user)
+
+async def load_user_fields(current_user: dict, fields: tuple) -> dict:
+    """The current user with the given heavy fields loaded, for endpoints that need them"""
+    user = await users.find_one({"_id": ObjectId(current_user["_id"])}, {field: 1 for field in fields}) or {}
+    return {**current_user, **{field: user[field] for field in fields if field in user}}
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     user_id = payload.get("sub")
-    user = await users.find_one({"_id": ObjectId(user_id)})
-    if user:
-        # Convert MongoDB document to dict and handle ObjectId
-        user_dict = dict(user)
-        user_dict["_id"] = str(user_dict["_id"])  # Convert ObjectId to string
-        return user_dict
-    return None 
\ No newline at end of file
+    return await load_user(user_id)
@@ -0,0 +1,56 @@
+import re
+from email.utils import parseaddr
+from typing import Dict, List
+
+# Categories stored on Email.category
+PERSONAL = "personal"
+TRANSACTIONAL = "transactional"
+PROMOTIONAL = "promotional"
+EMAIL_CATEGORIES = (PERSONAL, TRANSACTIONAL, PROMOTIONAL)
+
+# Categories kept out of AI context
+JUNK_CATEGORIES = (PROMOTIONAL,)
+
+PROMOTIONAL_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_FORUMS", "SPAM"}
+TRANSACTIONAL_LABELS = {"CATEGORY_UPDATES"}
+AUTOMATED_SENDER_RE = re.compile(r"^(no-?reply|do-?not-?reply|notifications?|alerts?|info|news(letter)?|marketing|hello|team)\b")
+TRANSACTIONAL_SUBJECT_RE = re.compile(
+    r"\b(receipt|invoice|order|payment|booking|reservation|confirm(ed|ation)?|itinerary|ticket|verify|verification|password|statement|shipped|delivery)\b",
+    re.IGNORECASE
+)
+
+def is_automated_sender(sender: str | None) -> bool:
+    """Whether a From address looks like a machine or role account (noreply@, info@, ...)"""
+    local_part = parseaddr(sender or "")[1].split("@")[0].lower()
+    return bool(AUTOMATED_SENDER_RE.match(local_part))
+
+def classify_email(label_ids: List[str], headers: Dict[str, str]) -> str:
+    """
+    Tag an email as promotional, transactional or personal from cheap local signals:
+    Gmail category labels, bulk-mail headers and sender/subject heuristics.
+    Only a category label or a bulk-mail header makes an email promotional; people
+    do write from info@ or hello@ addresses, so an automated-looking sender alone
+    just lowers the email's score in the AI context (see context.score_email).
+    headers maps lowercased header names to values.
+    """
+    labels = set(label_ids or [])
+    if labels & PROMOTIONAL_LABELS:
+        return PROMOTIONAL
+
+    subject = headers.get("subject", "")
+    is_automated = is_automated_sender(headers.get("from", ""))
+    is_bulk = "list-unsubscribe" in headers or headers.get("precedence", "").lower() in ("bulk", "list", "junk")
+
+    if labels & TRANSACTIONAL_LABELS or ((is_automated or is_bulk) and TRANSACTIONAL_SUBJECT_RE.search(subject)):
+        return TRANSACTIONAL
+    if is_bulk:
+        return PROMOTIONAL
+    return PERSONAL
+
+def category_filter(exclude_categories) -> dict:
+    """
+    Query condition excluding the given categories. An $in over the remaining
+    categories can use the (user_id, category, datetime) index; None keeps emails
+    stored before classification existed.
+    """
+    return {"$in": [c for c in EMAIL_CATEGORIES if c not in exclude_categories] + [None]}
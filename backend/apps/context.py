@@ -0,0 +1,166 @@
+import html
+import math
+import os
+import re
+from collections import Counter
+from email.utils import parseaddr
+from .classify import is_automated_sender
+
+# Approximate prompt size limits, in tokens
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "30000"))
+AI_CONTEXT_ITEM_TOKENS = int(os.getenv("AI_CONTEXT_ITEM_TOKENS", "800"))
+
+CHARS_PER_TOKEN = 4
+
+HTML_BLOCK_RE = re.compile(r"<(script|style|head)[^>]*>.*?</\1>", re.IGNORECASE | re.DOTALL)
+# Real tags only (a name right after "<" or "</"), so "<x@y.com>" survives
+HTML_TAG_RE = re.compile(r"</?[a-zA-Z][a-zA-Z0-9]*(?:\s[^<>]*)?/?>|<!--.*?-->", re.DOTALL)
+# Markup common in HTML mail bodies and calendar descriptions
+LOOKS_LIKE_HTML_RE = re.compile(r"<(?:html|body|head|div|p|br|span|a|table|tr|td|font|img|b|i|u|strong|em|ul|ol|li|style)\b[^<>]*>", re.IGNORECASE)
+URL_RE = re.compile(r"https?://\S{60,}")
+BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+# Lines that start the quoted part of a reply or forward
+QUOTE_MARKERS = [
+    re.compile(r"^On .+ wrote:\s*$"),
+    re.compile(r"^-+\s*Original Message\s*-+", re.IGNORECASE),
+    re.compile(r"^-+\s*Forwarded message\s*-+", re.IGNORECASE),
+    re.compile(r"^From: .+$"),
+    re.compile(r"^_{10,}\s*$"),
+]
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token), good enough for budgeting"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def strip_html(text: str) -> str:
+    """
+    Remove markup, scripts/styles and long tracking URLs, leaving readable text.
+    Plain text is left as is apart from the URLs, so angle-bracketed addresses
+    and other "<...>" text in it are kept.
+    """
+    if LOOKS_LIKE_HTML_RE.search(text):
+        text = HTML_BLOCK_RE.sub(" ", text)
+        text = HTML_TAG_RE.sub(" ", text)
+        text = html.unescape(text)
+    return URL_RE.sub("[link]", text)
+
+def strip_quoted_replies(text: str) -> str:
+    """Drop quoted history from replies and forwards, keeping only the new message"""
+    kept = []
+    has_content = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        is_quote = stripped.startswith(">") or any(marker.match(stripped) for marker in QUOTE_MARKERS)
+        # A message that is nothing but a forward keeps the forwarded text
+        if is_quote and has_content:
+            break
+        kept.append(line)
+        has_content = has_content or (bool(stripped) and not is_quote)
+    return "\n".join(kept)
+
+def clean_email_body(text: str | None) -> str:
+    """Strip HTML, quoted replies and extra whitespace from an email body"""
+    if not text:
+        return ""
+    text = strip_quoted_replies(strip_html(text))
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + " …"
+
+def sender_address(sender: str | None) -> str:
+    return parseaddr(sender or "")[1].lower()
+
+def score_email(email: dict, sender_counts: Counter, attendees: set) -> float:
+    """
+    Cheap importance score: starred mail and people the user meets with rank up,
+    senders who flood the inbox (newsletters, notifications) rank down.
+    """
+    address = sender_address(email.get("sender"))
+    score = 1.0
+    if email.get("is_starred"):
+        score += 3.0
+    if address in attendees:
+        score += 2.0
+    if is_automated_sender(address):
+        score -= 1.0
+    score -= math.log(sender_counts[address]) if sender_counts[address] > 1 else 0.0
+    return score
+
+def score_event(event: dict) -> float:
+    """Events with other people attending are more likely to be meaningful"""
+    return 2.0 + min(len(event.get("collaborators") or []), 5) * 0.5
+
+def render_event(event: dict) -> str:
+    text = f"Event: {event.get('event_name', 'Untitled')}\n"
+    text += f"Date: {event.get('datetime_start')}\n"
+    text += f"Description: {truncate_to_tokens(strip_html(event.get('description') or 'No description'), AI_CONTEXT_ITEM_TOKENS)}\n"
+    if event.get('location'):
+        text += f"Location: {event['location']}\n"
+    if event.get('collaborators'):
+        text += f"Collaborators: {', '.join(event['collaborators'])}\n"
+    return text + "\n"
+
+def render_email(email: dict) -> str:
+    text = f"From: {email.get('sender', 'Unknown')}\n"
+    text += f"Subject: {email.get('subject', 'No subject')}\n"
+    text += f"Date: {email.get('datetime')}\n"
+    body = truncate_to_tokens(clean_email_body(email.get('content')), AI_CONTEXT_ITEM_TOKENS)
+    return text + f"Content: {body or 'No content'}\n\n"
+
+def build_context(
+    events: list,
+    emails: list,
+    token_budget: int = AI_CONTEXT_TOKEN_BUDGET,
+    ranked: bool = True
+) -> tuple[str, dict]:
+    """
+    Render events and emails as prompt context within a token budget.
+    Items are cleaned and truncated, ranked by importance, and the best ones that
+    fit the budget are kept, then listed in their original order. Unranked, items
+    are taken oldest-inserted first (by _id) until the budget runs out, so the kept
+    items of each kind are a prefix of its list.
+    Returns the context and the indices of the kept items, per kind.
+    """
+    attendees = {address.lower() for event in events for address in event.get("collaborators") or []}
+    sender_counts = Counter(sender_address(email.get("sender")) for email in emails)
+
+    candidates = [
+        (score_event(event), str(event.get("_id")), "events", index, render_event(event))
+        for index, event in enumerate(events)
+    ] + [
+        (score_email(email, sender_counts, attendees), str(email.get("_id")), "emails", index, render_email(email))
+        for index, email in enumerate(emails)
+    ]
+    if ranked:
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    else:
+        candidates.sort(key=lambda candidate: candidate[1])
+
+    selected = {"events": [], "emails": []}
+    used = 0
+    for _, _, kind, index, text in candidates:
+        tokens = estimate_tokens(text)
+        if used + tokens > token_budget:
+            if ranked:
+                continue
+            # Skipping ahead would leave a gap before later items
+            break
+        selected[kind].append((index, text))
+        used += tokens
+
+    # Build context with events
+    context = "Recent calendar events:\n"
+    if selected["events"]:
+        context += "".join(text for _, text in sorted(selected["events"]))
+    else:
+        context += "No recent calendar events found.\n\n"
+
+    # Add emails to context
+    context += "Recent emails:\n"
+    if selected["emails"]:
+        context += "".join(text for _, text in sorted(selected["emails"]))
+    else:
+        context += "No recent emails found.\n"
+    return context, {kind: sorted(index for index, _ in items) for kind, items in selected.items()}
@@ -1,14 +1,20 @@
 from motor import motor_asyncio
 import os
+import re
 from typing import Annotated
 from pydantic import BeforeValidator
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from logging import getLogger
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = getLogger(__name__)
+
 client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
 db = client.get_database("production")
 PyObjectId = Annotated[str, BeforeValidator(str)]
@@ -16,12 +22,22 @@ PyObjectId = Annotated[str, BeforeValidator(str)]
 # Collections
 emails = db.get_collection("emails")
 pdfs = db.get_collection("pdfs")
+pdf_pages = db.get_collection("pdf_pages")
 photos = db.get_collection("photos")
 calendars = db.get_collection("calendars") 
 contacts = db.get_collection("contacts")
 users = db.get_collection("users")
 branches = db.get_collection("branches")
 nodes = db.get_collection("nodes")
+sync_state = db.get_collection("sync_state")
+jobs = db.get_collection("jobs")
+ai_cache = db.get_collection("ai_cache")
+ai_cache_stats = db.get_collection("ai_cache_stats")
+embeddings = db.get_collection("embeddings")
+skipped_messages = db.get_collection("skipped_messages")
+
+# Cached AI responses are evicted by MongoDB after this many seconds
+AI_CACHE_TTL_SECONDS = int(os.getenv("AI_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
 
 # Models
 from pydantic import BaseModel, Field
@@ -41,13 +57,27 @@ class Email(BaseMongoModel):
     is_starred: bool = False
     user_id: str
     content_hash: Optional[str] = None  # Hash of email content to prevent duplicates
+    gmail_id: Optional[str] = None  # Gmail message ID, lets syncs skip messages we already have
+    category: Optional[str] = None  # personal, transactional or promotional (see classify.py)
 
 class PDF(BaseMongoModel):
+    """Header of an uploaded PDF; its text is stored page by page in pdf_pages"""
     filename: Optional[str] = None
     title: Optional[str] = None
-    content: Optional[str] = None
+    content: Optional[str] = None  # Only on PDFs stored before per-page storage
     datetime: datetime
     user_id: str
+    status: str = "ready"  # processing, ready or failed; text is extracted in the background
+    page_count: Optional[int] = None
+    stored_page_count: Optional[int] = None  # Pages in pdf_pages; fewer than page_count when truncated
+    truncated: bool = False  # Text was cut at PDF_MAX_TEXT_CHARS
+    error: Optional[str] = None
+
+class PdfPage(BaseMongoModel):
+    pdf_id: str
+    user_id: str
+    page: int  # 1-based page number
+    content: str
 
 class Photo(BaseMongoModel):
     datetime: datetime
@@ -63,6 +93,9 @@ class Calendar(BaseMongoModel):
     description: Optional[str] = None
     collaborators: List[str] = []
     user_id: str
+    calendar_id: Optional[str] = None  # Google Calendar IDs; events stored before these were tracked have neither
+    event_id: Optional[str] = None
+    content_hash: Optional[str] = None  # Hash of event data, to tell when an event changed
 
 class Contact(BaseMongoModel):
     name: Optional[str] = None
@@ -84,6 +117,45 @@ class User(BaseModel):
     nodes_tmp: Optional[List[Any]] = []
     google_data: Optional[Dict[str, Any]] = None
     google_token: Optional[str] = None
+    google_token_expires_at: Optional[datetime] = None
+    google_refresh_token: Optional[str] = None
+
+class SyncState(BaseMongoModel):
+    user_id: str
+    kind: str  # e.g. "gmail"
+    cursor: Optional[str] = None  # Provider sync cursor (Gmail historyId, Calendar syncToken, ...)
+    updated_at: Optional[datetime] = None
+
+class Job(BaseMongoModel):
+    kind: str  # e.g. "sync_user_data"
+    user_id: str
+    status: str = "queued"  # queued, running, succeeded, failed
+    active: Optional[bool] = True  # Set while queued/running, used to dedup in-flight jobs
+    attempts: int = 0
+    max_attempts: int = 5
+    run_at: datetime
+    lease_expires_at: Optional[datetime] = None
+    worker_id: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+class TimelineNode(BaseModel):
+    """A life event generated by the AI (stored in User.nodes_tmp). No defaults: it doubles as the Gemini response schema"""
+    id: int
+    name: str
+    long_description: str
+    date: str
+
+class Embedding(BaseMongoModel):
+    user_id: str
+    kind: str  # Source collection: emails, calendars or pdfs
+    source_id: str
+    chunk: int  # Position of the chunk within the source document
+    vector: bytes  # Normalized float32 vector
+    created_at: datetime
 
 class Branch(BaseMongoModel):
     name: str
@@ -115,21 +187,229 @@ async def init_db():
     # Create indexes for users collection
     await users.create_index("email", unique=True)
     
-    # Create indexes for emails collection
-    await emails.create_index("content_hash")
+    # Create indexes for emails collection; (user_id, content_hash) below covers hash lookups
+    await drop_index_if_exists(emails, "content_hash_1")
     await emails.create_index("user_id")
     await emails.create_index("datetime")
 
+    # Dedup is enforced by the database: one document per (user, content hash)
+    unique_hash = {
+        "unique": True,
+        "partialFilterExpression": {"content_hash": {"$type": "string"}}
+    }
+    try:
+        await emails.create_index([("user_id", 1), ("content_hash", 1)], **unique_hash)
+    except DuplicateKeyError:
+        # Emails stored before the index existed may repeat; keep the oldest of each
+        removed = await remove_duplicate_emails()
+        logger.warning(f"Removed {removed} duplicate emails before building the unique content hash index")
+        await emails.create_index([("user_id", 1), ("content_hash", 1)], **unique_hash)
+
+    # Events are keyed by their Google IDs: the same event can sit in several
+    # calendars, and an edited event must update its document, not add another
+    await drop_index_if_exists(calendars, "user_id_1_content_hash_1")
+    await calendars.create_index(
+        [("user_id", 1), ("calendar_id", 1), ("event_id", 1)],
+        unique=True,
+        partialFilterExpression={"event_id": {"$type": "string"}}
+    )
+    # Matches events stored before the IDs were tracked
+    await calendars.create_index([("user_id", 1), ("content_hash", 1)], name="user_content_hash")
+
+    # Lookup of already-synced Gmail messages by provider ID
+    await emails.create_index([("user_id", 1), ("gmail_id", 1)])
+
+    # Gmail messages that were downloaded but can't be stored (no plain-text body)
+    await skipped_messages.create_index([("user_id", 1), ("gmail_id", 1)], unique=True)
+
+    # Category-filtered listings (e.g. AI context without promotional mail)
+    await emails.create_index([("user_id", 1), ("category", 1), ("datetime", -1)])
+
+    # One sync cursor per user and source
+    await sync_state.create_index([("user_id", 1), ("kind", 1)], unique=True)
+
+    # At most one in-flight job per user and kind; workers claim by status and due time
+    await jobs.create_index(
+        [("user_id", 1), ("kind", 1)],
+        unique=True,
+        partialFilterExpression={"active": True}
+    )
+    await jobs.create_index([("status", 1), ("run_at", 1)])
+
+    # AI response cache: lookups by prompt hash, TTL eviction by age
+    await ai_cache.create_index("key", unique=True)
+    await ai_cache.create_index("created_at", expireAfterSeconds=AI_CACHE_TTL_SECONDS)
+
+    # Keyset pagination of list endpoints on (sort field, _id)
+    await emails.create_index([("user_id", 1), ("datetime", -1), ("_id", -1)])
+    await calendars.create_index([("user_id", 1), ("datetime_start", 1), ("_id", 1)])
+    await pdfs.create_index([("user_id", 1), ("datetime", -1), ("_id", -1)])
+
+    # Full-text search; the user_id prefix scopes each search to one user's documents
+    await emails.create_index(
+        [("user_id", 1), ("subject", "text"), ("content", "text"), ("sender", "text")],
+        weights={"subject": 5, "sender": 2, "content": 1},
+        name="user_text"
+    )
+    await calendars.create_index(
+        [("user_id", 1), ("event_name", "text"), ("description", "text"), ("location", "text")],
+        weights={"event_name": 5, "location": 2, "description": 1},
+        name="user_text"
+    )
+    await pdfs.create_index(
+        [("user_id", 1), ("title", "text"), ("content", "text")],
+        weights={"title": 5, "content": 1},
+        name="user_text"
+    )
+
+    await pdf_pages.create_index(
+        [("user_id", 1), ("content", "text")],
+        name="user_text"
+    )
+
+    # Page range reads of a PDF's text
+    await pdf_pages.create_index([("pdf_id", 1), ("page", 1)], unique=True)
+
+    # Embedding chunks are loaded per user and looked up by source document
+    await embeddings.create_index([("user_id", 1), ("kind", 1), ("source_id", 1)])
+
+async def remove_duplicate_emails() -> int:
+    """Delete all but the oldest email per (user_id, content_hash), with their embeddings"""
+    duplicates = emails.aggregate([
+        {"$match": {"content_hash": {"$type": "string"}}},
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {"user_id": "$user_id", "content_hash": "$content_hash"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+    removed = 0
+    async for group in duplicates:
+        extra = group["ids"][1:]
+        await emails.delete_many({"_id": {"$in": extra}})
+        await embeddings.delete_many({"kind": "emails", "source_id": {"$in": [str(_id) for _id in extra]}})
+        removed += len(extra)
+    return removed
+
+async def drop_index_if_exists(collection, name: str):
+    """Drop an index that an older version of init_db created"""
+    if name in await collection.index_information():
+        await collection.drop_index(name)
+
+async def get_sync_cursor(user_id: str, kind: str) -> Optional[str]:
+    """Get the stored provider sync cursor for a user, if any"""
+    state = await sync_state.find_one({"user_id": user_id, "kind": kind})
+    return state.get("cursor") if state else None
+
+async def get_sync_cursors(user_id: str, kind_prefix: str) -> Dict[str, str]:
+    """Get all of a user's sync cursors whose kind starts with kind_prefix, keyed by kind"""
+    cursor = sync_state.find({"user_id": user_id, "kind": {"$regex": f"^{re.escape(kind_prefix)}"}})
+    return {state["kind"]: state["cursor"] async for state in cursor if state.get("cursor")}
+
+async def set_sync_cursor(user_id: str, kind: str, cursor: Optional[str]):
+    """Store (or clear, with None) the provider sync cursor for a user"""
+    await sync_state.update_one(
+        {"user_id": user_id, "kind": kind},
+        {"$set": {"cursor": cursor, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def upsert_by_content_hash(collection, documents: List[Dict[str, Any]], update_fields: tuple = ()) -> List[Dict[str, Any]]:
+    """
+    Insert documents that are not already stored for their user, keyed on
+    (user_id, content_hash), in one unordered bulk write. Fields listed in
+    update_fields are refreshed on documents that already exist.
+    Returns the newly inserted documents, with their _id set.
+    """
+    if not documents:
+        return []
+
+    operations = []
+    for document in documents:
+        update = {"$setOnInsert": {k: v for k, v in document.items() if k not in update_fields}}
+        if update_fields:
+            update["$set"] = {k: document[k] for k in update_fields if k in document}
+        operations.append(UpdateOne(
+            {"user_id": document["user_id"], "content_hash": document["content_hash"]},
+            update,
+            upsert=True
+        ))
+
+    result = await collection.bulk_write(operations, ordered=False)
+    return [{**documents[index], "_id": _id} for index, _id in result.upserted_ids.items()]
+
+def event_key_filter(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Query for the stored copy of an event: by its Google IDs, or for events stored
+    before the IDs were tracked, by content hash.
+    """
+    return {
+        "user_id": event["user_id"],
+        "$or": [
+            {"calendar_id": event["calendar_id"], "event_id": event["event_id"]},
+            {"event_id": None, "content_hash": event["content_hash"]}
+        ]
+    }
+
+async def upsert_events(events: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Insert new events and overwrite stored ones keyed on (user_id, calendar_id,
+    event_id), in one unordered bulk write.
+    Returns the inserted events and the stored events whose content changed, with their _id set.
+    """
+    if not events:
+        return [], []
+
+    # Previous content hashes, to tell edited events from unchanged ones
+    stored = {}
+    async for document in calendars.find(
+        {"$or": [event_key_filter(event) for event in events]},
+        {"calendar_id": 1, "event_id": 1, "content_hash": 1}
+    ):
+        stored[(document.get("calendar_id"), document.get("event_id"))] = document
+        stored.setdefault((None, document.get("content_hash")), document)
+
+    operations = [UpdateOne(event_key_filter(event), {"$set": event}, upsert=True) for event in events]
+    result = await calendars.bulk_write(operations, ordered=False)
+    inserted = [{**events[index], "_id": _id} for index, _id in result.upserted_ids.items()]
+
+    changed = []
+    for index, event in enumerate(events):
+        if index in result.upserted_ids:
+            continue
+        previous = stored.get((event["calendar_id"], event["event_id"])) or stored.get((None, event["content_hash"]))
+        if previous and previous.get("content_hash") != event["content_hash"]:
+            changed.append({**event, "_id": previous["_id"]})
+    return inserted, changed
+
+async def delete_events(user_id: str, cancelled: List[tuple]) -> List[str]:
+    """Delete the user's stored events by (calendar_id, event_id); returns the deleted IDs"""
+    if not cancelled:
+        return []
+    query = {
+        "user_id": user_id,
+        "$or": [{"calendar_id": calendar_id, "event_id": event_id} for calendar_id, event_id in cancelled]
+    }
+    ids = [document["_id"] async for document in calendars.find(query, {"_id": 1})]
+    if ids:
+        await calendars.delete_many({"_id": {"$in": ids}})
+    return [str(_id) for _id in ids]
+
 async def drop_all_collections():
     """Drop all collections except users for development purposes"""
     collections_to_drop = [
         emails,
         pdfs,
+        pdf_pages,
         photos,
         calendars,
         contacts,
         branches,
-        nodes
+        nodes,
+        sync_state,
+        jobs,
+        ai_cache,
+        ai_cache_stats,
+        embeddings,
+        skipped_messages
     ]
     
     for collection in collections_to_drop:
@@ -1,14 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from bson import ObjectId
 from .db import emails
 from .fetch_emails import sync_emails
+from .classify import category_filter
 from .auth import get_current_user
+from .google_auth import get_valid_access_token, GoogleAuthError
+from .pagination import paginate, InvalidCursorError
 
 router = APIRouter(
     prefix="/emails",
     tags=["emails"]
 )
 
+# Email bodies are only returned by the single-email endpoint
+LIST_PROJECTION = {"content": 0}
+
 @router.get("/sync")
 async def sync_user_emails(current_user: dict = Depends(get_current_user)):
     """Sync emails from Gmail to our database"""
@@ -19,41 +25,71 @@ async def sync_user_emails(current_user: dict = Depends(get_current_user)):
     number_of_emails = 100  # You can make this configurable via query parameter
     
     try:
-        count = await sync_emails(current_user["google_token"], user_id, number_of_emails)
+        access_token = await get_valid_access_token(user_id)
+    except GoogleAuthError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+    try:
+        count = await sync_emails(access_token, user_id, number_of_emails)
         return {"message": f"Successfully synced {count} new emails"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 async def get_user_emails(
     current_user: dict,
-    skip: int = 0,
     limit: int = 50,
-    starred_only: bool = False
+    cursor: str | None = None,
+    starred_only: bool = False,
+    inserted_after: str | None = None,
+    exclude_categories: tuple = (),
+    projection: dict | None = None,
+    include_total: bool = False
 ):
-    """Get user's emails with pagination and filtering"""
+    """
+    Get a page of the user's emails, newest first, with keyset pagination on
+    (datetime, _id): pass the returned next_cursor to get the following page.
+    With inserted_after, only emails stored after that document ID are returned,
+    oldest-inserted first, so callers can advance a watermark.
+    exclude_categories drops emails classified into those categories at ingest.
+    """
     user_id = str(current_user["_id"])
     
     # Build query
     query = {"user_id": user_id}
     if starred_only:
         query["is_starred"] = True
+    if exclude_categories:
+        query["category"] = category_filter(exclude_categories)
+    if inserted_after:
+        query["_id"] = {"$gt": ObjectId(inserted_after)}
     
-    # Get total count
-    total = await emails.count_documents(query)
-    
-    # Get emails with pagination
-    cursor = emails.find(query)
-    cursor = cursor.sort("datetime", -1)  # Sort by date descending
-    cursor = cursor.skip(skip).limit(limit)
-    
-    email_list = await cursor.to_list(None)
-    
-    return {
-        "total": total,
-        "skip": skip,
-        "limit": limit,
-        "emails": email_list
-    }
+    if inserted_after:
+        page = await paginate(emails, query, "_id", 1, limit, cursor, projection, include_total)
+    else:
+        page = await paginate(emails, query, "datetime", -1, limit, cursor, projection, include_total)
+    page["emails"] = page.pop("items")
+    return page
+
+@router.get("")
+async def list_emails(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = None,
+    starred_only: bool = False,
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """List the user's emails without their bodies; fetch one by ID for its content"""
+    try:
+        return await get_user_emails(
+            current_user,
+            limit=limit,
+            cursor=cursor,
+            starred_only=starred_only,
+            projection=LIST_PROJECTION,
+            include_total=include_total
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/count")
 async def count_emails(current_user: dict = Depends(get_current_user)):
@@ -0,0 +1,161 @@
+import asyncio
+import os
+from collections import OrderedDict
+from datetime import datetime
+from logging import getLogger
+from typing import List, Dict, Any
+import numpy as np
+from .context import clean_email_body, strip_html
+from .db import embeddings, Embedding
+
+logger = getLogger(__name__)
+
+# Local sentence-transformers model, so indexing and search work offline
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_CHUNK_WORDS = int(os.getenv("EMBEDDING_CHUNK_WORDS", "200"))
+EMBEDDING_CHUNK_OVERLAP = 40
+# Number of users whose vector matrices are kept in memory
+EMBEDDING_INDEX_CACHE_USERS = int(os.getenv("EMBEDDING_INDEX_CACHE_USERS", "32"))
+
+_model = None
+_model_lock = asyncio.Lock()
+
+class UserIndex:
+    """All of a user's chunk vectors as one float32 matrix, with the source of each row"""
+
+    def __init__(self, matrix: np.ndarray, refs: List[tuple]):
+        self.matrix = matrix
+        self.refs = refs  # (kind, source_id) per row
+
+# user_id -> UserIndex, least recently used first
+_indexes: "OrderedDict[str, UserIndex]" = OrderedDict()
+
+async def get_model():
+    """Load the embedding model once per process, off the event loop"""
+    global _model
+    async with _model_lock:
+        if _model is None:
+            from sentence_transformers import SentenceTransformer
+            _model = await asyncio.to_thread(SentenceTransformer, EMBEDDING_MODEL)
+    return _model
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts as unit-length float32 vectors (so a dot product is cosine similarity)"""
+    model = await get_model()
+    vectors = await asyncio.to_thread(model.encode, texts, batch_size=32, normalize_embeddings=True)
+    return np.asarray(vectors, dtype=np.float32)
+
+def chunk_text(text: str, max_words: int = EMBEDDING_CHUNK_WORDS, overlap: int = EMBEDDING_CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping word windows"""
+    words = text.split()
+    if not words:
+        return []
+    step = max(max_words - overlap, 1)
+    return [" ".join(words[i:i + max_words]) for i in range(0, max(len(words) - overlap, 1), step)]
+
+def document_text(kind: str, document: Dict[str, Any]) -> str:
+    """The searchable text of an email, event or PDF document"""
+    if kind == "emails":
+        return f"{document.get('subject') or ''}\n{clean_email_body(document.get('content'))}"
+    if kind == "calendars":
+        parts = [document.get("event_name"), strip_html(document.get("description") or ""), document.get("location")]
+        return "\n".join(part for part in parts if part)
+    if kind == "pdfs":
+        return f"{document.get('title') or ''}\n{document.get('content') or ''}"
+    raise ValueError(f"Unknown embedding kind: {kind}")
+
+async def index_documents(kind: str, documents: List[Dict[str, Any]]) -> int:
+    """
+    Chunk, embed and store newly ingested documents. Errors are logged rather than
+    raised so a missing model never fails ingestion. Returns the number of chunks stored.
+    """
+    chunks = []
+    for document in documents:
+        for position, text in enumerate(chunk_text(document_text(kind, document))):
+            chunks.append((document, position, text))
+    if not chunks:
+        return 0
+
+    try:
+        vectors = await embed_texts([text for _, _, text in chunks])
+        now = datetime.utcnow()
+        await embeddings.insert_many([
+            Embedding(
+                user_id=document["user_id"],
+                kind=kind,
+                source_id=str(document["_id"]),
+                chunk=position,
+                vector=vector.tobytes(),
+                created_at=now
+            ).model_dump()
+            for (document, position, _), vector in zip(chunks, vectors)
+        ])
+    except Exception as e:
+        logger.error(f"Error indexing {len(documents)} {kind} for embeddings: {e}")
+        return 0
+
+    for user_id in {document["user_id"] for document, _, _ in chunks}:
+        _indexes.pop(user_id, None)
+    return len(chunks)
+
+async def remove_documents(kind: str, user_id: str, source_ids: List[str]):
+    """Delete the chunks of documents that were removed or are about to be re-indexed"""
+    if not source_ids:
+        return
+    await embeddings.delete_many({"user_id": user_id, "kind": kind, "source_id": {"$in": source_ids}})
+    _indexes.pop(user_id, None)
+
+async def load_user_index(user_id: str) -> UserIndex:
+    """
+    Get the user's vectors as one matrix, from memory when possible. Other processes
+    (workers) also write embeddings, so a cached index is reloaded when the stored
+    chunk count no longer matches.
+    """
+    index = _indexes.get(user_id)
+    stored = await embeddings.count_documents({"user_id": user_id})
+    if index is not None and len(index.refs) == stored:
+        _indexes.move_to_end(user_id)
+        return index
+
+    refs = []
+    vectors = []
+    async for chunk in embeddings.find({"user_id": user_id}, {"kind": 1, "source_id": 1, "vector": 1, "_id": 0}):
+        refs.append((chunk["kind"], chunk["source_id"]))
+        vectors.append(np.frombuffer(chunk["vector"], dtype=np.float32))
+    matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    index = UserIndex(matrix, refs)
+    _indexes[user_id] = index
+    while len(_indexes) > EMBEDDING_INDEX_CACHE_USERS:
+        _indexes.popitem(last=False)
+    return index
+
+async def search(user_id: str, query: str, k: int = 10, kinds: tuple | None = None) -> List[Dict[str, Any]]:
+    """
+    Brute-force top-k semantic search over the user's emails, events and PDFs.
+    Returns the best-matching source documents (one hit per document) with scores.
+    """
+    index = await load_user_index(user_id)
+    if not index.refs:
+        return []
+
+    query_vector = (await embed_texts([query]))[0]
+    scores = index.matrix @ query_vector
+    if kinds:
+        allowed = np.array([kind in kinds for kind, _ in index.refs])
+        scores = np.where(allowed, scores, -np.inf)
+
+    hits = []
+    seen = set()
+    # Chunks of the same document can fill the top rows, so over-fetch before de-duplicating
+    candidates = min(len(scores), k * 4)
+    top = np.argpartition(-scores, candidates - 1)[:candidates]
+    for row in top[np.argsort(-scores[top])]:
+        if not np.isfinite(scores[row]) or index.refs[row] in seen:
+            continue
+        seen.add(index.refs[row])
+        kind, source_id = index.refs[row]
+        hits.append({"kind": kind, "source_id": source_id, "score": float(scores[row])})
+        if len(hits) == k:
+            break
+    return hits
@@ -1,15 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from bson import ObjectId
 from datetime import datetime, timedelta, UTC
 from .db import calendars
 from .fetch_events import sync_events
 from .auth import get_current_user
+from .google_auth import get_valid_access_token, GoogleAuthError
+from .pagination import paginate, InvalidCursorError
 
 router = APIRouter(
     prefix="/events",
     tags=["events"]
 )
 
+# Descriptions are only returned by the single-event endpoint
+LIST_PROJECTION = {"description": 0}
+
 @router.get("/sync")
 async def sync_user_events(current_user: dict = Depends(get_current_user)):
     """Sync events from Google Calendar to our database"""
@@ -22,19 +27,32 @@ async def sync_user_events(current_user: dict = Depends(get_current_user)):
     start_time = datetime.now(UTC).isoformat() + "Z"
     end_time = (datetime.now(UTC) + timedelta(days=60)).isoformat() + "Z"
     try:
-        count = await sync_events(current_user["google_token"], user_id, start_time, end_time)
+        access_token = await get_valid_access_token(user_id)
+    except GoogleAuthError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+    try:
+        count = await sync_events(access_token, user_id, start_time, end_time)
         return {"message": f"Successfully synced {count} new events"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 async def get_user_events(
     current_user: dict = Depends(get_current_user),
-    skip: int = 0,
     limit: int = 50,
+    cursor: str | None = None,
     start_date: datetime | None = None,
-    end_date: datetime | None = None
+    end_date: datetime | None = None,
+    inserted_after: str | None = None,
+    projection: dict | None = None,
+    include_total: bool = False
 ):
-    """Get user's events with pagination and date filtering"""
+    """
+    Get a page of the user's events by start time, with keyset pagination on
+    (datetime_start, _id): pass the returned next_cursor to get the following page.
+    With inserted_after, only events stored after that document ID are returned,
+    oldest-inserted first, so callers can advance a watermark.
+    """
     user_id = str(current_user["_id"])
     
     # Build query
@@ -42,27 +60,38 @@ async def get_user_events(
     if start_date and end_date:
         query["datetime_start"] = {"$gte": start_date}
         query["datetime_end"] = {"$lte": end_date}
+    if inserted_after:
+        query["_id"] = {"$gt": ObjectId(inserted_after)}
     
-    # Get total count
-    total = await calendars.count_documents(query)
-    
-    # Get events with pagination
-    cursor = calendars.find(query)
-    cursor = cursor.sort("datetime_start", 1)  # Sort by start time ascending
-    cursor = cursor.skip(skip).limit(limit)
-    
-    event_list = await cursor.to_list(None)
-    
-    # Convert ObjectIds to strings
-    for event in event_list:
-        event["_id"] = str(event["_id"])
-    
-    return {
-        "total": total,
-        "skip": skip,
-        "limit": limit,
-        "events": event_list
-    }
+    if inserted_after:
+        page = await paginate(calendars, query, "_id", 1, limit, cursor, projection, include_total)
+    else:
+        page = await paginate(calendars, query, "datetime_start", 1, limit, cursor, projection, include_total)
+    page["events"] = page.pop("items")
+    return page
+
+@router.get("")
+async def list_events(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = None,
+    start_date: datetime | None = None,
+    end_date: datetime | None = None,
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """List the user's events without their descriptions; fetch one by ID for the details"""
+    try:
+        return await get_user_events(
+            current_user,
+            limit=limit,
+            cursor=cursor,
+            start_date=start_date,
+            end_date=end_date,
+            projection=LIST_PROJECTION,
+            include_total=include_total
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/count")
 async def count_events(current_user: dict = Depends(get_current_user)):
@@ -1,11 +1,30 @@
-import requests
+import asyncio
 import base64
-import json
-import time
 import hashlib
+import os
 from datetime import datetime
-from typing import List, Dict, Any
-from .db import emails, Email
+from typing import List, Dict, Any, AsyncIterator
+from urllib.parse import urlparse
+from pymongo import UpdateOne
+from .classify import classify_email
+from .embeddings import index_documents
+from .db import emails, skipped_messages, Email, get_sync_cursor, set_sync_cursor, upsert_by_content_hash
+from .google_api import GMAIL_API_BASE, GMAIL_BATCH_URL, request_with_backoff, google_get, google_batch_get, NotFoundError
+
+# Maximum number of message bodies (or batch requests) downloaded in parallel per sync
+GMAIL_FETCH_CONCURRENCY = int(os.getenv("GMAIL_FETCH_CONCURRENCY", "10"))
+# Gmail accepts at most 100 sub-requests per batch call
+GMAIL_BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "100")), 100)
+# Use batch requests for message hydration by default (useful for large backfills)
+GMAIL_USE_BATCH = os.getenv("GMAIL_USE_BATCH", "false").lower() == "true"
+# Number of emails written to MongoDB per bulk write while streaming a sync
+EMAIL_SYNC_BATCH_SIZE = int(os.getenv("EMAIL_SYNC_BATCH_SIZE", "50"))
+
+class HistoryExpiredError(Exception):
+    """Raised when a stored Gmail historyId is too old for history.list and a full sync is needed"""
+
+class MessageFetchError(Exception):
+    """Raised after a sync when some messages could not be downloaded, so the sync cursor stays put"""
 
 def generate_email_hash(content: str, sender: str, subject: str, datetime: datetime) -> str:
     """Generate a unique hash for an email based on its content and metadata"""
@@ -14,114 +33,396 @@ def generate_email_hash(content: str, sender: str, subject: str, datetime: datet
     # Generate SHA-256 hash
     return hashlib.sha256(hash_input.encode('utf-8')).hexdigest()
 
-async def get_recent_emails(access_token: str, user_id: str, number: int = 100) -> List[Dict[str, Any]]:
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+def parse_message(message_data: Dict[str, Any], user_id: str) -> Dict[str, Any] | None:
+    """Convert a Gmail API message resource into an Email dict, or None if it has no plain-text body"""
+    msg_id = message_data.get('id')
+    payload = message_data.get('payload', {})
+    encoded_bytes = None
+
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
+                encoded_bytes = part['body']['data']
+                break
+    elif 'body' in payload and 'data' in payload['body']:
+        encoded_bytes = payload['body']['data']
+
+    if not encoded_bytes:
+        return None
+
+    try:
+        decoded_bytes = base64.urlsafe_b64decode(encoded_bytes).decode('utf-8')
+    except Exception as e:
+        print(f"⚠️ Could not decode message {msg_id}: {e}")
+        return None
+
+    headers_list = payload.get('headers', [])
+    headers_dict = {h['name'].lower(): h['value'] for h in headers_list}
+
+    # Parse the date string
+    date_str = headers_dict.get('date', "")
+    try:
+        # Try to parse the date string
+        email_date = datetime.strptime(date_str.split(" +")[0], "%a, %d %b %Y %H:%M:%S")
+    except:
+        email_date = datetime.utcnow()
+
+    sender = headers_dict.get('from', "No sender")
+    subject = headers_dict.get('subject', "No subject")
+
+    # Generate content hash
+    content_hash = generate_email_hash(decoded_bytes, sender, subject, email_date)
 
+    email_data = Email(
+        sender=sender,
+        subject=subject,
+        datetime=email_date,
+        content=decoded_bytes,
+        is_starred=1 if 'STARRED' in message_data.get('labelIds', []) else 0,
+        user_id=user_id,
+        content_hash=content_hash,
+        gmail_id=msg_id,
+        category=classify_email(message_data.get('labelIds', []), headers_dict)
+    )
+    return email_data.model_dump()
+
+async def fetch_message(access_token: str, msg_id: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Fetch a single full message, holding a concurrency slot for the duration of the request"""
+    async with semaphore:
+        response = await request_with_backoff(
+            "GET",
+            f"{GMAIL_API_BASE}/users/me/messages/{msg_id}",
+            headers={"Authorization": f"Bearer {access_token}"}
+        )
+    # Deleted since it was listed (history.list still reports drafts and trashed mail)
+    if response.status_code == 404:
+        raise NotFoundError(msg_id)
+    # Still failing after retries: an error body must not be parsed as an empty message
+    if response.status_code != 200:
+        raise Exception(f"Gmail returned {response.status_code}")
+    return response.json()
+
+async def fetch_message_batch(access_token: str, msg_ids: List[str], semaphore: asyncio.Semaphore) -> List[Dict[str, Any] | None]:
+    """Fetch up to GMAIL_BATCH_SIZE full messages with a single multipart batch request"""
+    api_path = urlparse(GMAIL_API_BASE).path
+    async with semaphore:
+        return await google_batch_get(
+            GMAIL_BATCH_URL,
+            [f"{api_path}/users/me/messages/{msg_id}" for msg_id in msg_ids],
+            access_token
+        )
+
+async def hydrate_messages(
+    access_token: str,
+    msg_ids: List[str],
+    semaphore: asyncio.Semaphore,
+    batch: bool = False
+) -> List[Dict[str, Any] | Exception | None]:
+    """Download full message resources for msg_ids, in order, either one call per message or batched"""
+    if not batch:
+        return await asyncio.gather(
+            *(fetch_message(access_token, msg_id, semaphore) for msg_id in msg_ids),
+            return_exceptions=True
+        )
+
+    chunks = [msg_ids[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(msg_ids), GMAIL_BATCH_SIZE)]
+    results = await asyncio.gather(
+        *(fetch_message_batch(access_token, chunk, semaphore) for chunk in chunks),
+        return_exceptions=True
+    )
+    messages = []
+    for chunk, result in zip(chunks, results):
+        messages.extend(result if not isinstance(result, Exception) else [result] * len(chunk))
+    return messages
+
+async def fetch_emails_by_id(
+    access_token: str,
+    user_id: str,
+    msg_ids: List[str],
+    semaphore: asyncio.Semaphore,
+    batch: bool = False
+) -> tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Download and decode the given messages. Returns the decoded emails and the IDs
+    of messages that could not be downloaded; messages that no longer exist or
+    have no plain-text body are skipped as expected, and the latter recorded so
+    they aren't downloaded again.
+    """
     fetched_emails = []
-    base_url = "https://gmail.googleapis.com/gmail/v1/users/me/messages"
-    max_per_page = 100  # Gmail allows up to 500    
+    failed_ids = []
+    skipped_ids = []
+    messages = await hydrate_messages(access_token, msg_ids, semaphore, batch=batch)
+    for msg_id, message_data in zip(msg_ids, messages):
+        if isinstance(message_data, NotFoundError):
+            print(f"🗑️ Message {msg_id} was deleted, skipping")
+            continue
+        if isinstance(message_data, Exception) or message_data is None:
+            print(f"⚠️ Could not fetch message {msg_id}: {message_data}")
+            failed_ids.append(msg_id)
+            continue
+
+        email_data = parse_message(message_data, user_id)
+        if email_data:
+            fetched_emails.append(email_data)
+        else:
+            skipped_ids.append(msg_id)
+    await record_skipped_messages(user_id, skipped_ids)
+    return fetched_emails, failed_ids
+
+async def record_skipped_messages(user_id: str, msg_ids: List[str]):
+    """Remember messages that can't be stored, so later listings don't download them again"""
+    if not msg_ids:
+        return
+    now = datetime.utcnow()
+    await skipped_messages.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "gmail_id": msg_id},
+            {"$setOnInsert": {"skipped_at": now}},
+            upsert=True
+        )
+        for msg_id in msg_ids
+    ], ordered=False)
+
+async def filter_unknown_message_ids(user_id: str, msg_ids: List[str]) -> List[str]:
+    """
+    Drop message IDs that are already stored (or were skipped) for this user,
+    keeping the original order
+    """
+    if not msg_ids:
+        return []
+    known = set()
+    for collection in (emails, skipped_messages):
+        cursor = collection.find(
+            {"user_id": user_id, "gmail_id": {"$in": msg_ids}},
+            {"gmail_id": 1, "_id": 0}
+        )
+        known.update([doc["gmail_id"] async for doc in cursor])
+    return [msg_id for msg_id in msg_ids if msg_id not in known]
+
+async def update_message_labels(user_id: str, labels: Dict[str, List[str]]) -> int:
+    """Apply label changes from history.list to stored emails without refetching them"""
+    if not labels:
+        return 0
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "gmail_id": msg_id},
+            {"$set": {"is_starred": 'STARRED' in label_ids}}
+        )
+        for msg_id, label_ids in labels.items()
+    ]
+    result = await emails.bulk_write(operations, ordered=False)
+    return result.modified_count
+
+async def get_mailbox_history_id(access_token: str) -> str | None:
+    """Get the mailbox's current historyId, the starting point for later incremental syncs"""
+    profile = await google_get(f"{GMAIL_API_BASE}/users/me/profile", access_token)
+    return profile.get("historyId")
+
+async def list_changed_message_ids(
+    access_token: str,
+    start_history_id: str
+) -> tuple[List[str], Dict[str, List[str]], str]:
+    """
+    List messages added or relabelled since start_history_id using history.list.
+    Returns the added message IDs, the latest labelIds of every changed message and
+    the mailbox's new historyId. Raises HistoryExpiredError when Gmail no longer has
+    history that far back.
+    """
+    msg_ids = {}
+    labels = {}
+    params = {
+        "startHistoryId": start_history_id,
+        "historyTypes": ["messageAdded", "labelAdded", "labelRemoved"],
+        "maxResults": 500
+    }
+    history_id = start_history_id
+
+    while True:
+        response = await request_with_backoff(
+            "GET",
+            f"{GMAIL_API_BASE}/users/me/history",
+            headers={"Authorization": f"Bearer {access_token}"},
+            params=params
+        )
+        if response.status_code == 404:
+            raise HistoryExpiredError(f"historyId {start_history_id} is no longer available")
+        data = response.json()
+        if "historyId" not in data:
+            raise Exception(f"Error fetching history: {data}")
+
+        history_id = data["historyId"]
+        for record in data.get("history", []):
+            for change in record.get("messagesAdded", []):
+                # Dict keeps first-seen order while de-duplicating
+                msg_ids[change["message"]["id"]] = True
+            for key in ("messagesAdded", "labelsAdded", "labelsRemoved"):
+                for change in record.get(key, []):
+                    # Later records carry the newer label set
+                    labels[change["message"]["id"]] = change["message"].get("labelIds", [])
+
+        if "nextPageToken" not in data:
+            break
+        params["pageToken"] = data["nextPageToken"]
+
+    return list(msg_ids), labels, history_id
+
+async def iter_listed_message_ids(
+    access_token: str,
+    user_id: str,
+    number: int,
+    max_per_page: int = 100,
+    skip_known: bool = True
+) -> AsyncIterator[List[str]]:
+    """Yield pages of the `number` most recent message IDs, minus already-stored ones when skip_known"""
+    listed = 0
+    base_url = f"{GMAIL_API_BASE}/users/me/messages"
     params = {
         "maxResults": min(number, max_per_page)
     }
 
-    while len(fetched_emails) < number:
-        response = requests.get(base_url, headers=headers, params=params).json()
+    while listed < number:
+        response = await google_get(base_url, access_token, params=params)
 
         if "messages" not in response:
             print("Error fetching messages:", response)
             break
 
-        for message in response['messages']:
-            if len(fetched_emails) >= number:
-                break
-                
-            msg_id = message['id']
-            message_data = requests.get(
-                f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}",
-                headers=headers
-            ).json()
-
-            payload = message_data.get('payload', {})
-            encoded_bytes = None
-
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
-                        encoded_bytes = part['body']['data']
-                        break
-            elif 'body' in payload and 'data' in payload['body']:
-                encoded_bytes = payload['body']['data']
-
-            if not encoded_bytes:
-                continue
-
-            try:
-                decoded_bytes = base64.urlsafe_b64decode(encoded_bytes).decode('utf-8')
-            except Exception as e:
-                print(f"⚠️ Could not decode message {msg_id}: {e}")
-                continue
-
-            headers_list = payload.get('headers', [])
-            headers_dict = {h['name'].lower(): h['value'] for h in headers_list}
-
-            # Parse the date string
-            date_str = headers_dict.get('date', "")
-            try:
-                # Try to parse the date string
-                email_date = datetime.strptime(date_str.split(" +")[0], "%a, %d %b %Y %H:%M:%S")
-            except:
-                email_date = datetime.utcnow()
-
-            sender = headers_dict.get('from', "No sender")
-            subject = headers_dict.get('subject', "No subject")
-            
-            # Generate content hash
-            content_hash = generate_email_hash(decoded_bytes, sender, subject, email_date)
-
-            email_data = Email(
-                sender=sender,
-                subject=subject,
-                datetime=email_date,
-                content=decoded_bytes,
-                is_starred=1 if 'STARRED' in message_data.get('labelIds', []) else 0,
-                user_id=user_id,
-                content_hash=content_hash
-            )
-            
-            fetched_emails.append(email_data.model_dump())
-
-        print(f"✅ Fetched batch: {len(response['messages'])} — Total collected: {len(fetched_emails)}")
+        msg_ids = [message['id'] for message in response['messages']][:number - listed]
+        listed += len(msg_ids)
+        if skip_known:
+            msg_ids = await filter_unknown_message_ids(user_id, msg_ids)
+        print(f"✅ Listed batch: {len(response['messages'])} — {len(msg_ids)} to fetch")
+        yield msg_ids
 
         if "nextPageToken" in response:
             params["pageToken"] = response["nextPageToken"]
-            params["maxResults"] = min(number - len(fetched_emails), max_per_page)
-            time.sleep(0.3)  # Avoid hitting rate limits
+            params["maxResults"] = min(number - listed, max_per_page)
         else:
             break
 
-    return fetched_emails
-
-async def sync_emails(access_token: str, user_id: str, number: int = 100):
-    """Sync emails from Gmail to MongoDB"""
-    # Get existing email hashes for this user
-    existing_emails = await emails.find({"user_id": user_id}).to_list(None)
-    existing_hashes = {email.get("content_hash") for email in existing_emails}
-    
-    # Fetch new emails
-    new_emails = await get_recent_emails(access_token, user_id, number)
-    
-    # Filter out emails we already have based on content hash
-    emails_to_insert = [
-        email for email in new_emails 
-        if email.get("content_hash") not in existing_hashes
-    ]
-    
-    if emails_to_insert:
-        result = await emails.insert_many(emails_to_insert)
-        print(f"✅ Added {len(emails_to_insert)} new emails")
-        return len(emails_to_insert)
+async def iter_emails(
+    access_token: str,
+    user_id: str,
+    id_pages: AsyncIterator[List[str]],
+    concurrency: int = GMAIL_FETCH_CONCURRENCY,
+    batch: bool = False
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Fetch, decode and hash messages one page of IDs at a time, yielding Email dicts.
+    The next page is only downloaded once the consumer has taken the current one.
+    Raises MessageFetchError at the end if any message failed to download, after
+    yielding everything that did.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+    async for msg_ids in id_pages:
+        # Download the page's message bodies in parallel, bounded by the semaphore
+        fetched_emails, failed_ids = await fetch_emails_by_id(access_token, user_id, msg_ids, semaphore, batch=batch)
+        failed += len(failed_ids)
+        for email_data in fetched_emails:
+            yield email_data
+    if failed:
+        raise MessageFetchError(f"{failed} messages could not be fetched")
+
+async def iter_id_chunks(msg_ids: List[str], size: int = 100) -> AsyncIterator[List[str]]:
+    """Yield an already-known list of message IDs in pages"""
+    for i in range(0, len(msg_ids), size):
+        yield msg_ids[i:i + size]
+
+async def get_recent_emails(
+    access_token: str,
+    user_id: str,
+    number: int = 100,
+    concurrency: int = GMAIL_FETCH_CONCURRENCY,
+    batch: bool = False,
+    skip_known: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Fetch and decode the user's `number` most recent messages.
+    With skip_known=True, messages whose Gmail ID is already stored are not downloaded.
+    With batch=True, message bodies are fetched through Gmail batch requests
+    of up to GMAIL_BATCH_SIZE messages each instead of one call per message.
+    """
+    max_per_page = 500 if batch else 100  # Gmail allows up to 500
+    id_pages = iter_listed_message_ids(access_token, user_id, number, max_per_page, skip_known)
+    return [email async for email in iter_emails(access_token, user_id, id_pages, concurrency, batch)]
+
+async def store_emails(email_stream: AsyncIterator[Dict[str, Any]], batch_size: int = EMAIL_SYNC_BATCH_SIZE) -> int:
+    """
+    Write a stream of Email dicts to MongoDB in batches of batch_size.
+    Fetching runs ahead of the writes through a bounded queue, so at most a couple
+    of batches are held in memory, and every completed batch is kept if the run fails.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 2)
+    done = object()
+
+    async def produce():
+        try:
+            async for email in email_stream:
+                await queue.put(email)
+        except Exception:
+            # Let the consumer flush what it has before the error is re-raised
+            await queue.put(done)
+            raise
+        await queue.put(done)
+
+    producer = asyncio.create_task(produce())
+    inserted = 0
+    try:
+        pending = []
+        while True:
+            item = await queue.get()
+            if item is not done:
+                pending.append(item)
+            if pending and (item is done or len(pending) >= batch_size):
+                # The unique (user_id, content_hash) index skips emails we already have;
+                # matches on older documents get their gmail_id backfilled
+                new_emails = await upsert_by_content_hash(emails, pending, update_fields=("is_starred", "gmail_id", "category"))
+                await index_documents("emails", new_emails)
+                inserted += len(new_emails)
+                pending = []
+            if item is done:
+                break
+        # Surface any error raised while fetching
+        await producer
+    finally:
+        producer.cancel()
+    return inserted
+
+async def sync_emails(access_token: str, user_id: str, number: int = 100, batch: bool = GMAIL_USE_BATCH):
+    """
+    Sync emails from Gmail to MongoDB.
+    The first sync lists the newest `number` messages; later syncs use the stored
+    historyId to fetch only messages changed since then, falling back to a full
+    sync when the cursor has expired. Emails are streamed into the database in
+    batches, and the cursor only advances once the whole run has succeeded:
+    if any message fails to download, the emails that did are kept and
+    MessageFetchError is raised, so the next run lists the failed ones again.
+    """
+    id_pages = None
+    history_id = await get_sync_cursor(user_id, "gmail")
+    if history_id:
+        try:
+            msg_ids, labels, history_id = await list_changed_message_ids(access_token, history_id)
+            await update_message_labels(user_id, labels)
+            msg_ids = await filter_unknown_message_ids(user_id, msg_ids)
+            print(f"🔄 Incremental sync: {len(msg_ids)} new messages, {len(labels)} label changes")
+            id_pages = iter_id_chunks(msg_ids)
+        except HistoryExpiredError:
+            print("⚠️ Gmail sync cursor expired, running full sync")
+
+    if id_pages is None:
+        # Read the historyId before listing so nothing that arrives mid-sync is missed next time
+        history_id = await get_mailbox_history_id(access_token)
+        max_per_page = 500 if batch else 100
+        id_pages = iter_listed_message_ids(access_token, user_id, number, max_per_page)
+
+    inserted = await store_emails(iter_emails(access_token, user_id, id_pages, batch=batch))
+    if inserted:
+        print(f"✅ Added {inserted} new emails")
     else:
         print("📭 No new emails to add")
-        return 0 
\ No newline at end of file
+
+    if history_id:
+        await set_sync_cursor(user_id, "gmail", history_id)
+    return inserted
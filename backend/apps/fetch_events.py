@@ -1,10 +1,19 @@
-import requests
-import json
-import urllib
+import asyncio
+import os
+import urllib.parse
 import hashlib
 from datetime import datetime
 from typing import List, Dict, Any
-from .db import calendars, Calendar
+from .db import Calendar, upsert_events, delete_events, get_sync_cursors, set_sync_cursor
+from .embeddings import index_documents, remove_documents
+from .google_api import CALENDAR_API_BASE, request_with_backoff, google_get
+
+# Maximum number of calendars fetched in parallel per sync
+CALENDAR_FETCH_CONCURRENCY = int(os.getenv("CALENDAR_FETCH_CONCURRENCY", "10"))
+SYNC_KIND_PREFIX = "calendar:"
+
+class SyncTokenExpiredError(Exception):
+    """Raised when Google Calendar rejects a stored syncToken and a full fetch is needed"""
 
 def generate_event_hash(event_name: str, start_time: datetime, end_time: datetime, description: str) -> str:
     """Generate a unique hash for an event based on its content and metadata"""
@@ -13,98 +22,181 @@ def generate_event_hash(event_name: str, start_time: datetime, end_time: datetim
     # Generate SHA-256 hash
     return hashlib.sha256(hash_input.encode('utf-8')).hexdigest()
 
-async def get_recent_events(access_token: str, user_id: str, startTS: str, endTS: str) -> List[Dict[str, Any]]:
-    """Gets events from all calendars between startTS and endTS"""
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+def parse_event(event: Dict[str, Any], user_id: str, calendar_id: str) -> Dict[str, Any] | None:
+    """Convert a Calendar API event resource into a Calendar dict, or None if it can't be used"""
+
+    # Parse start and end times
+    start = event.get('start', {}).get('dateTime') or event.get('start', {}).get('date')
+    end = event.get('end', {}).get('dateTime') or event.get('end', {}).get('date')
 
     try:
-        # Get list of user's calendars
-        response = requests.get(
-            "https://www.googleapis.com/calendar/v3/users/me/calendarList",
-            headers=headers
-        ).json()
-
-        if 'items' not in response:
-            print("Error fetching calendars:", response)
-            return []
-
-        fetched_events = []
-        for calendar in response['items']:
-            encoded_id = urllib.parse.quote(calendar['id'], safe='')
-            calendar_data = requests.get(
-                f"https://www.googleapis.com/calendar/v3/calendars/{encoded_id}/events?timeMin={startTS}&timeMax={endTS}",
-                headers=headers
-            ).json()
-
-            if 'items' not in calendar_data:
-                print(f"No events in calendar {calendar.get('summary', 'Unknown')}")
+        start_dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
+        end_dt = datetime.fromisoformat(end.replace('Z', '+00:00'))
+    except (ValueError, TypeError, AttributeError):
+        print(f"⚠️ Could not parse dates for event {event.get('id')}")
+        return None
+
+    event_name = event.get('summary', "No event name")
+    description = event.get('description', "No description")
+
+    # Generate content hash
+    content_hash = generate_event_hash(
+        event_name,
+        start_dt,
+        end_dt,
+        description
+    )
+
+    event_data = Calendar(
+        datetime_start=start_dt,
+        datetime_end=end_dt,
+        event_name=event_name,
+        location=event.get('location', "No location"),
+        description=description,
+        collaborators=[attendee.get('email', "No email") for attendee in event.get('attendees', [])] if 'attendees' in event else [],
+        user_id=user_id,
+        calendar_id=calendar_id,
+        event_id=event['id'],
+        content_hash=content_hash
+    )
+    return event_data.model_dump()
+
+async def fetch_calendar_events(
+    access_token: str,
+    user_id: str,
+    calendar: Dict[str, Any],
+    startTS: str,
+    endTS: str,
+    sync_token: str | None = None
+) -> tuple[List[Dict[str, Any]], List[str], str | None]:
+    """
+    Fetch every page of one calendar's events. With a sync_token only changes since
+    the previous sync are returned; otherwise events between startTS and endTS.
+    Returns the parsed events, the IDs of cancelled events and the calendar's next syncToken.
+    """
+    encoded_id = urllib.parse.quote(calendar['id'], safe='')
+    url = f"{CALENDAR_API_BASE}/calendars/{encoded_id}/events"
+    # syncToken can't be combined with a time window
+    params = {"syncToken": sync_token} if sync_token else {"timeMin": startTS, "timeMax": endTS}
+    params["maxResults"] = 2500
+
+    fetched_events = []
+    cancelled_ids = []
+    while True:
+        response = await request_with_backoff(
+            "GET",
+            url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            params=params
+        )
+        if response.status_code == 410:
+            raise SyncTokenExpiredError(f"syncToken for calendar {calendar['id']} expired")
+        calendar_data = response.json()
+
+        if 'items' not in calendar_data:
+            print(f"No events in calendar {calendar.get('summary', 'Unknown')}")
+            return fetched_events, cancelled_ids, None
+
+        for event in calendar_data['items']:
+            # Deleted events (and declined invites) come back as cancelled stubs
+            if event.get('status') == 'cancelled':
+                cancelled_ids.append(event['id'])
                 continue
+            event_data = parse_event(event, user_id, calendar['id'])
+            if event_data:
+                fetched_events.append(event_data)
 
-            for event in calendar_data['items']:
-                # Parse start and end times
-                start = event.get('start', {}).get('dateTime') or event.get('start', {}).get('date')
-                end = event.get('end', {}).get('dateTime') or event.get('end', {}).get('date')
-                
-                try:
-                    start_dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                    end_dt = datetime.fromisoformat(end.replace('Z', '+00:00'))
-                except (ValueError, TypeError):
-                    print(f"⚠️ Could not parse dates for event {event.get('id')}")
-                    continue
-
-                event_name = event.get('summary', "No event name")
-                description = event.get('description', "No description")
-                
-                # Generate content hash
-                content_hash = generate_event_hash(
-                    event_name,
-                    start_dt,
-                    end_dt,
-                    description
-                )
+        if "nextPageToken" not in calendar_data:
+            break
+        params["pageToken"] = calendar_data["nextPageToken"]
 
-                event_data = Calendar(
-                    datetime_start=start_dt,
-                    datetime_end=end_dt,
-                    event_name=event_name,
-                    location=event.get('location', "No location"),
-                    description=description,
-                    collaborators=[attendee.get('email', "No email") for attendee in event.get('attendees', [])] if 'attendees' in event else [],
-                    user_id=user_id,
-                    content_hash=content_hash
+    print(f"✅ Fetched {len(fetched_events)} events from calendar {calendar.get('summary', 'Unknown')}")
+    return fetched_events, cancelled_ids, calendar_data.get("nextSyncToken")
+
+async def get_calendar_changes(
+    access_token: str,
+    user_id: str,
+    startTS: str,
+    endTS: str,
+    sync_tokens: Dict[str, str]
+) -> tuple[List[Dict[str, Any]], List[tuple], Dict[str, str]]:
+    """
+    Fetch events from all of the user's calendars concurrently.
+    sync_tokens maps calendar IDs to syncTokens from a previous run; calendars with a
+    valid token only return changes. Returns the events, the (calendar ID, event ID)
+    of cancelled events and the new syncTokens.
+    """
+    # Get list of user's calendars
+    response = await google_get(f"{CALENDAR_API_BASE}/users/me/calendarList", access_token)
+
+    if 'items' not in response:
+        print("Error fetching calendars:", response)
+        return [], [], {}
+
+    semaphore = asyncio.Semaphore(CALENDAR_FETCH_CONCURRENCY)
+
+    async def fetch(calendar):
+        async with semaphore:
+            try:
+                return await fetch_calendar_events(
+                    access_token, user_id, calendar, startTS, endTS, sync_tokens.get(calendar['id'])
                 )
-                
-                fetched_events.append(event_data.model_dump())
+            except SyncTokenExpiredError:
+                print(f"⚠️ Sync token expired for calendar {calendar.get('summary', 'Unknown')}, refetching")
+                return await fetch_calendar_events(access_token, user_id, calendar, startTS, endTS)
 
-            print(f"✅ Fetched {len(calendar_data['items'])} events from calendar {calendar.get('summary', 'Unknown')}")
+    results = await asyncio.gather(*(fetch(calendar) for calendar in response['items']), return_exceptions=True)
 
-        return fetched_events
+    fetched_events = []
+    cancelled = []
+    next_tokens = {}
+    for calendar, result in zip(response['items'], results):
+        if isinstance(result, Exception):
+            print(f"Error fetching events for calendar {calendar.get('summary', 'Unknown')}: {result}")
+            continue
+        events, cancelled_ids, next_token = result
+        fetched_events.extend(events)
+        cancelled.extend((calendar['id'], event_id) for event_id in cancelled_ids)
+        if next_token:
+            next_tokens[calendar['id']] = next_token
+
+    return fetched_events, cancelled, next_tokens
 
+async def get_recent_events(access_token: str, user_id: str, startTS: str, endTS: str) -> List[Dict[str, Any]]:
+    """Gets events from all calendars between startTS and endTS"""
+    try:
+        fetched_events, _, _ = await get_calendar_changes(access_token, user_id, startTS, endTS, {})
+        return fetched_events
     except Exception as e:
         print(f"Error fetching events: {e}")
         return []
 
 async def sync_events(access_token: str, user_id: str, startTS: str, endTS: str):
-    """Sync events from Google Calendar to MongoDB"""
-    # Get existing event hashes for this user
-    existing_events = await calendars.find({"user_id": user_id}).to_list(None)
-    existing_hashes = {event.get("content_hash") for event in existing_events}
-    
+    """
+    Sync events from Google Calendar to MongoDB.
+    Calendars are fetched in parallel; after the first sync each calendar's stored
+    syncToken is used so only changed events are downloaded. Edited events are
+    updated in place and cancelled ones deleted.
+    """
+    stored = await get_sync_cursors(user_id, SYNC_KIND_PREFIX)
+    sync_tokens = {kind.removeprefix(SYNC_KIND_PREFIX): token for kind, token in stored.items()}
+
     # Fetch new events
-    new_events = await get_recent_events(access_token, user_id, startTS, endTS)
-    
-    # Filter out events we already have based on content hash
-    events_to_insert = [
-        event for event in new_events 
-        if event.get("content_hash") not in existing_hashes
-    ]
-    
-    if events_to_insert:
-        result = await calendars.insert_many(events_to_insert)
-        print(f"✅ Added {len(events_to_insert)} new events")
-        return len(events_to_insert)
+    new_events, cancelled, next_tokens = await get_calendar_changes(access_token, user_id, startTS, endTS, sync_tokens)
+
+    inserted_events, changed_events = await upsert_events(new_events)
+    deleted_ids = await delete_events(user_id, cancelled)
+    await remove_documents("calendars", user_id, [str(event["_id"]) for event in changed_events] + deleted_ids)
+    await index_documents("calendars", inserted_events + changed_events)
+    inserted = len(inserted_events)
+    if inserted or changed_events or deleted_ids:
+        print(f"✅ Added {inserted} new events, updated {len(changed_events)}, removed {len(deleted_ids)}")
     else:
         print("📅 No new events to add")
-        return 0
\ No newline at end of file
+
+    # Only advance the cursors once the events are stored
+    await asyncio.gather(*(
+        set_sync_cursor(user_id, f"{SYNC_KIND_PREFIX}{calendar_id}", token)
+        for calendar_id, token in next_tokens.items()
+    ))
+    return inserted
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import random
+import re
+import uuid
+import httpx
+from logging import getLogger
+from typing import Any
+
+logger = getLogger(__name__)
+
+# Base URLs can be pointed at a local fake server for benchmarking
+GMAIL_API_BASE = os.getenv("GMAIL_API_BASE", "https://gmail.googleapis.com/gmail/v1")
+GMAIL_BATCH_URL = os.getenv("GMAIL_BATCH_URL", "https://www.googleapis.com/batch/gmail/v1")
+CALENDAR_API_BASE = os.getenv("CALENDAR_API_BASE", "https://www.googleapis.com/calendar/v3")
+
+# Connection pool / retry configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv("GOOGLE_HTTP_MAX_CONNECTIONS", "50"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_HTTP_TIMEOUT_SECONDS", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("GOOGLE_HTTP_MAX_RETRIES", "5"))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_client: httpx.AsyncClient | None = None
+
+class NotFoundError(Exception):
+    """The requested resource no longer exists (HTTP 404); retrying won't help"""
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the process-wide pooled HTTP client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS
+            )
+        )
+    return _client
+
+async def close_http_client():
+    """Close the shared HTTP client (called on app shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def request_with_backoff(method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request, retrying rate-limited and transient failures with exponential backoff"""
+    client = get_http_client()
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            logger.warning(f"Transport error calling {url}: {e}")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_MAX_RETRIES:
+                return response
+            logger.warning(f"Got {response.status_code} from {url}, backing off")
+
+        # Exponential backoff with jitter, without blocking the event loop
+        await asyncio.sleep(min(2 ** attempt, 32) * 0.5 + random.random() * 0.5)
+
+async def google_get(url: str, access_token: str, params: dict | None = None) -> dict:
+    """GET a Google API endpoint and return the decoded JSON body"""
+    response = await request_with_backoff(
+        "GET",
+        url,
+        headers={"Authorization": f"Bearer {access_token}"},
+        params=params
+    )
+    return response.json()
+
+def build_batch_body(paths: list[str], boundary: str) -> str:
+    """Encode a list of GET request paths as a multipart/mixed batch body"""
+    parts = [
+        f"--{boundary}\r\n"
+        "Content-Type: application/http\r\n"
+        f"Content-ID: <item{index}>\r\n"
+        "\r\n"
+        f"GET {path}\r\n"
+        "\r\n"
+        for index, path in enumerate(paths)
+    ]
+    return "".join(parts) + f"--{boundary}--\r\n"
+
+def parse_batch_response(content_type: str, body: str) -> dict[int, tuple[int, Any]]:
+    """Decode a multipart/mixed batch response into {request index: (status, json body)}"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError(f"Batch response has no boundary: {content_type}")
+    boundary = match.group(1)
+
+    results = {}
+    for part in body.replace("\r\n", "\n").split(f"--{boundary}"):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+
+        outer_headers, _, http_response = part.partition("\n\n")
+        content_id = re.search(r"content-id:\s*<(?:response-)?item(\d+)>", outer_headers, re.IGNORECASE)
+        if not content_id:
+            continue
+
+        status_line, _, rest = http_response.partition("\n")
+        _, _, payload = rest.partition("\n\n")
+        try:
+            status = int(status_line.split()[1])
+            data = json.loads(payload) if payload.strip() else {}
+        except (IndexError, ValueError):
+            continue
+        results[int(content_id.group(1))] = (status, data)
+
+    return results
+
+async def google_batch_get(batch_url: str, paths: list[str], access_token: str) -> list[Any]:
+    """
+    Issue GET requests for many API paths in a single batch call.
+    Sub-requests that are rate limited are retried with backoff; any that still
+    fail come back as None, in the same order as paths. Sub-requests answered with
+    404 come back as a NotFoundError instead, so callers can tell "gone" from "failed".
+    """
+    results: list[Any] = [None] * len(paths)
+    pending = list(range(len(paths)))
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        boundary = f"batch_{uuid.uuid4().hex}"
+        response = await request_with_backoff(
+            "POST",
+            batch_url,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": f"multipart/mixed; boundary={boundary}"
+            },
+            content=build_batch_body([paths[i] for i in pending], boundary)
+        )
+        if response.status_code != 200:
+            logger.error(f"Batch request failed with {response.status_code}: {response.text[:200]}")
+            return results
+
+        parsed = parse_batch_response(response.headers.get("content-type", ""), response.text)
+        retry = []
+        for position, index in enumerate(pending):
+            status, data = parsed.get(position, (None, None))
+            if status == 200:
+                results[index] = data
+            elif status == 404:
+                results[index] = NotFoundError(paths[index])
+            elif status in RETRY_STATUS_CODES or status is None:
+                retry.append(index)
+            else:
+                logger.warning(f"Batch sub-request {paths[index]} failed with {status}")
+
+        if not retry:
+            break
+        pending = retry
+        await asyncio.sleep(min(2 ** attempt, 32) * 0.5 + random.random() * 0.5)
+
+    return results
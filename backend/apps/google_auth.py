@@ -0,0 +1,133 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from logging import getLogger
+from bson import ObjectId
+from .db import users
+from .auth import invalidate_user
+from .google_api import request_with_backoff
+
+logger = getLogger(__name__)
+
+GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
+GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v1/userinfo"
+
+# Refresh access tokens this long before Google expires them
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+# user_id -> (access token, expiry in naive UTC), shared by all jobs in this process
+_tokens: dict[str, tuple[str, datetime]] = {}
+# One refresh per user at a time; concurrent callers wait and reuse its token
+_locks: dict[str, asyncio.Lock] = {}
+
+class GoogleAuthError(Exception):
+    """No usable Google credentials; the user has to log in with Google again"""
+
+def token_fields(token_data: dict) -> dict:
+    """User fields to $set from a Google token response"""
+    fields = {"google_token": token_data["access_token"]}
+    if token_data.get("expires_in"):
+        fields["google_token_expires_at"] = datetime.utcnow() + timedelta(seconds=int(token_data["expires_in"]))
+    # Google only returns a refresh token on consent; keep the stored one otherwise
+    if token_data.get("refresh_token"):
+        fields["google_refresh_token"] = token_data["refresh_token"]
+    return fields
+
+async def post_token_request(data: dict) -> dict:
+    """POST to Google's OAuth token endpoint, raising GoogleAuthError on failure"""
+    response = await request_with_backoff("POST", GOOGLE_TOKEN_URL, data={
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        **data
+    })
+    token_data = response.json()
+    if response.status_code != 200 or not token_data.get("access_token"):
+        raise GoogleAuthError(f"Google token request failed: {token_data.get('error', response.status_code)}")
+    return token_data
+
+async def exchange_code(code: str) -> dict:
+    """Exchange an OAuth authorization code for access and refresh tokens"""
+    return await post_token_request({
+        "code": code,
+        "redirect_uri": GOOGLE_REDIRECT_URI,
+        "grant_type": "authorization_code",
+    })
+
+async def fetch_user_info(access_token: str) -> dict:
+    """Profile of the Google account the access token belongs to"""
+    response = await request_with_backoff(
+        "GET",
+        GOOGLE_USERINFO_URL,
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    if response.status_code != 200:
+        raise GoogleAuthError(f"Google userinfo request failed with {response.status_code}")
+    return response.json()
+
+def remember_token(user_id: str, access_token: str, expires_at: datetime | None):
+    if expires_at:
+        _tokens[user_id] = (access_token, expires_at)
+
+def cached_token(user_id: str) -> str | None:
+    """The in-memory access token if it is not about to expire"""
+    token = _tokens.get(user_id)
+    if token and token[1] - timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS) > datetime.utcnow():
+        return token[0]
+    return None
+
+async def refresh_access_token(user_id: str, refresh_token: str) -> str:
+    """Get a new access token with the refresh token and store it on the user"""
+    token_data = await post_token_request({
+        "refresh_token": refresh_token,
+        "grant_type": "refresh_token",
+    })
+    fields = token_fields(token_data)
+    await users.update_one({"_id": ObjectId(user_id)}, {"$set": fields})
+    invalidate_user(user_id)
+    remember_token(user_id, fields["google_token"], fields.get("google_token_expires_at"))
+    logger.info(f"Refreshed Google access token for user {user_id}")
+    return fields["google_token"]
+
+async def get_valid_access_token(user_id: str) -> str:
+    """
+    A Google access token for the user that is valid for at least
+    TOKEN_REFRESH_MARGIN_SECONDS. Tokens are refreshed before they expire and
+    reused across concurrent jobs; only one refresh per user runs at a time.
+    Raises GoogleAuthError when the user has to log in again.
+    """
+    user_id = str(user_id)
+    token = cached_token(user_id)
+    if token:
+        return token
+
+    lock = _locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        # Another job may have refreshed while we waited
+        token = cached_token(user_id)
+        if token:
+            return token
+
+        user = await users.find_one(
+            {"_id": ObjectId(user_id)},
+            {"google_token": 1, "google_token_expires_at": 1, "google_refresh_token": 1}
+        )
+        if not user:
+            raise GoogleAuthError("User not found")
+
+        expires_at = user.get("google_token_expires_at")
+        if user.get("google_token") and expires_at:
+            # Another process may already have refreshed and stored a fresh token
+            remember_token(user_id, user["google_token"], expires_at)
+            token = cached_token(user_id)
+            if token:
+                return token
+
+        if user.get("google_refresh_token"):
+            return await refresh_access_token(user_id, user["google_refresh_token"])
+        if user.get("google_token") and not expires_at:
+            # Logged in before expiry was tracked; the token may still work
+            return user["google_token"]
+        raise GoogleAuthError("No valid Google token found. Please login with Google again.")
@@ -0,0 +1,136 @@
+from fastapi import APIRouter, Depends, HTTPException
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from logging import getLogger
+import os
+from .db import jobs, Job
+from .auth import get_current_user
+
+logger = getLogger(__name__)
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))  # A crashed worker's job is retried after this
+JOB_HEARTBEAT_SECONDS = JOB_LEASE_SECONDS / 3  # Running jobs renew their lease this often
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"]
+)
+
+def serialize_job(job: dict) -> dict:
+    """Convert a job document into a JSON-safe status dict"""
+    job = dict(job)
+    job["_id"] = str(job["_id"])
+    job.pop("active", None)
+    job.pop("worker_id", None)
+    return job
+
+async def enqueue_job(kind: str, user_id: str) -> dict:
+    """
+    Queue a job for a user, unless one of the same kind is already queued or running,
+    in which case the in-flight job is returned instead.
+    """
+    now = datetime.utcnow()
+    job = Job(
+        kind=kind,
+        user_id=user_id,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        run_at=now,
+        created_at=now,
+        updated_at=now
+    ).model_dump()
+    try:
+        result = await jobs.insert_one(job)
+        job["_id"] = result.inserted_id
+        return job
+    except DuplicateKeyError:
+        existing = await jobs.find_one({"user_id": user_id, "kind": kind, "active": True})
+        if existing:
+            return existing
+        # The in-flight job finished between the insert and the lookup
+        return await enqueue_job(kind, user_id)
+
+async def claim_job(worker_id: str) -> dict | None:
+    """Atomically claim the next due job, including running jobs whose worker lease has expired"""
+    now = datetime.utcnow()
+    return await jobs.find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ]
+        },
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_lease(job: dict) -> bool:
+    """Extend a running job's lease; False if the job is no longer held by this worker"""
+    now = datetime.utcnow()
+    result = await jobs.update_one(
+        {"_id": job["_id"], "worker_id": job.get("worker_id"), "status": "running"},
+        {"$set": {"lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}}
+    )
+    return result.matched_count == 1
+
+async def complete_job(job: dict, result: dict):
+    """Mark a job as succeeded and release its per-user slot"""
+    now = datetime.utcnow()
+    await jobs.update_one(
+        {"_id": job["_id"], "worker_id": job.get("worker_id")},
+        {
+            "$set": {"status": "succeeded", "result": result, "error": None, "finished_at": now, "updated_at": now},
+            "$unset": {"active": "", "lease_expires_at": ""}
+        }
+    )
+
+async def fail_job(job: dict, error: str):
+    """Schedule a retry with exponential backoff, or mark the job failed once attempts run out"""
+    now = datetime.utcnow()
+    if job["attempts"] < job.get("max_attempts", JOB_MAX_ATTEMPTS):
+        delay = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+        logger.warning(f"Job {job['_id']} failed (attempt {job['attempts']}), retrying in {delay}s: {error}")
+        await jobs.update_one(
+            {"_id": job["_id"], "worker_id": job.get("worker_id")},
+            {
+                "$set": {"status": "queued", "error": error, "run_at": now + timedelta(seconds=delay), "updated_at": now},
+                "$unset": {"lease_expires_at": ""}
+            }
+        )
+    else:
+        logger.error(f"Job {job['_id']} failed permanently after {job['attempts']} attempts: {error}")
+        await jobs.update_one(
+            {"_id": job["_id"], "worker_id": job.get("worker_id")},
+            {
+                "$set": {"status": "failed", "error": error, "finished_at": now, "updated_at": now},
+                "$unset": {"active": "", "lease_expires_at": ""}
+            }
+        )
+
+@router.get("/{job_id}")
+async def get_job_status(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the status of one of the user's background jobs"""
+    job = await jobs.find_one({
+        "_id": ObjectId(job_id),
+        "user_id": str(current_user["_id"])
+    })
+
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return serialize_job(job)
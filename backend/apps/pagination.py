@@ -0,0 +1,76 @@
+import base64
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+
+class InvalidCursorError(ValueError):
+    """A page cursor that is malformed or was issued for a different sort"""
+
+def encode_cursor(sort_field: str, document: dict) -> str:
+    """Opaque cursor pointing just past the document in (sort_field, _id) order"""
+    position = {"f": sort_field, "v": document.get(sort_field), "id": document["_id"]}
+    return base64.urlsafe_b64encode(json_util.dumps(position).encode()).decode()
+
+def decode_cursor(cursor: str, sort_field: str) -> tuple:
+    """The (sort value, _id) a cursor points past"""
+    try:
+        position = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        last_id = ObjectId(position["id"])
+    except (ValueError, KeyError, TypeError, InvalidId) as e:
+        raise InvalidCursorError("Invalid page cursor") from e
+    if position.get("f") != sort_field:
+        raise InvalidCursorError("Page cursor does not match this listing")
+    return position.get("v"), last_id
+
+def keyset_filter(sort_field: str, direction: int, cursor: str) -> dict:
+    """
+    Query condition for the rows after a cursor in (sort_field, _id) order. With a
+    matching compound index this seeks straight to the page instead of skipping rows.
+    """
+    value, last_id = decode_cursor(cursor, sort_field)
+    op = "$gt" if direction == 1 else "$lt"
+    if sort_field == "_id":
+        return {"_id": {op: last_id}}
+    return {"$or": [
+        {sort_field: {op: value}},
+        {sort_field: value, "_id": {op: last_id}}
+    ]}
+
+async def paginate(
+    collection,
+    query: dict,
+    sort_field: str,
+    direction: int = -1,
+    limit: int = 50,
+    cursor: str | None = None,
+    projection: dict | None = None,
+    include_total: bool = False
+) -> dict:
+    """
+    One page of a keyset-paginated listing, ordered by (sort_field, _id).
+    Returns the page's documents (with string IDs), the cursor for the next page
+    (None on the last page) and, only when asked for, the total match count.
+    """
+    page_query = dict(query)
+    if cursor:
+        page_query = {"$and": [query, keyset_filter(sort_field, direction, cursor)]}
+
+    sort = [("_id", direction)] if sort_field == "_id" else [(sort_field, direction), ("_id", direction)]
+    # One extra row tells whether there is a next page without counting
+    documents = await collection.find(page_query, projection).sort(sort).limit(limit + 1).to_list(None)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(sort_field, documents[-1])
+
+    for document in documents:
+        document["_id"] = str(document["_id"])
+
+    page = {
+        "limit": limit,
+        "next_cursor": next_cursor,
+        "items": documents
+    }
+    if include_total:
+        page["total"] = await collection.count_documents(query)
+    return page
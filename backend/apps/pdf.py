@@ -1,96 +1,304 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile, File, Query, Request
+from fastapi.routing import APIRoute
 from bson import ObjectId
-from .db import pdfs
+from pymongo import ReturnDocument
+from concurrent.futures import ProcessPoolExecutor
+from .db import pdfs, pdf_pages, PDF, PdfPage
 from .auth import get_current_user
-import pdfplumber
-import io
-from datetime import datetime
+from .embeddings import index_documents
+from .pagination import paginate, InvalidCursorError
+from .pdf_extract import extract_pdf
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Number of PDFs extracted in parallel, each in its own process
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+# Uploads are streamed to disk in chunks and rejected past the size limit
+PDF_MAX_UPLOAD_BYTES = int(os.getenv("PDF_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+PDF_UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Room for the multipart boundaries and headers around the file in a request body
+PDF_UPLOAD_OVERHEAD_BYTES = 64 * 1024
+# Extracted text beyond this many characters is dropped
+PDF_MAX_TEXT_CHARS = int(os.getenv("PDF_MAX_TEXT_CHARS", "5000000"))
+# Pages returned by a single PDF read
+PDF_PAGE_RANGE_LIMIT = 50
+# Uploads waiting for extraction live here, so leftovers can be found after a restart
+PDF_UPLOAD_DIR = os.getenv("PDF_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "gradual-pdf-uploads"))
+# A PDF still processing after this long was abandoned by a restarted process
+PDF_PROCESSING_TIMEOUT_SECONDS = int(os.getenv("PDF_PROCESSING_TIMEOUT_SECONDS", "3600"))
+
+_extract_pool: ProcessPoolExecutor | None = None
+
+def upload_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"PDF exceeds {PDF_MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+
+class UploadLimitRoute(APIRoute):
+    """
+    Rejects oversized request bodies while they arrive. FastAPI parses (and spools
+    to disk) the whole multipart form before the endpoint runs, so a check there
+    would only fire once the upload had been received.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        limit = PDF_MAX_UPLOAD_BYTES + PDF_UPLOAD_OVERHEAD_BYTES
+
+        async def limited_handler(request: Request):
+            content_length = request.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > limit:
+                raise upload_too_large()
+
+            # Chunked bodies have no Content-Length; count bytes as they come in
+            received = 0
+
+            async def receive():
+                nonlocal received
+                message = await request.receive()
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise upload_too_large()
+                return message
+
+            return await handler(Request(request.scope, receive))
+
+        return limited_handler
 
 router = APIRouter(
     prefix="/pdfs",
-    tags=["pdfs"]
+    tags=["pdfs"],
+    route_class=UploadLimitRoute
 )
 
+# Extracted text is only returned by the single-PDF endpoint
+LIST_PROJECTION = {"content": 0}
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    """Process pool for PDF extraction, created on first use"""
+    global _extract_pool
+    if _extract_pool is None:
+        # spawn: don't fork a process holding the event loop and DB client threads
+        _extract_pool = ProcessPoolExecutor(
+            max_workers=PDF_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _extract_pool
+
+def shutdown_extract_pool():
+    """Stop the extraction processes (called on app shutdown)"""
+    global _extract_pool
+    if _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+        _extract_pool = None
+
+async def save_upload(file: UploadFile) -> str:
+    """
+    Stream an upload to a temporary file in fixed-size chunks, so the whole PDF
+    is never held in memory. Raises 413 past PDF_MAX_UPLOAD_BYTES; the router's
+    UploadLimitRoute has already turned away request bodies far over it.
+    """
+    os.makedirs(PDF_UPLOAD_DIR, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", dir=PDF_UPLOAD_DIR, delete=False)
+    size = 0
+    try:
+        while chunk := await file.read(PDF_UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > PDF_MAX_UPLOAD_BYTES:
+                raise upload_too_large()
+            await asyncio.to_thread(tmp.write, chunk)
+    except BaseException:
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+    tmp.close()
+    return tmp.name
+
+async def process_pdf(pdf_id: ObjectId, user_id: str, path: str):
+    """Extract an uploaded PDF's text in the process pool and store it on its document"""
+    try:
+        loop = asyncio.get_running_loop()
+        extracted = await loop.run_in_executor(get_extract_pool(), extract_pdf, path, PDF_MAX_TEXT_CHARS)
+    except Exception as e:
+        logger.error(f"Error extracting PDF {pdf_id}: {e}")
+        await pdfs.update_one({"_id": pdf_id}, {"$set": {"status": "failed", "error": str(e)}})
+        return
+    finally:
+        os.unlink(path)
+
+    try:
+        await store_pdf_pages(pdf_id, user_id, extracted)
+    except Exception as e:
+        logger.error(f"Error storing PDF {pdf_id}: {e}")
+        # Don't leave half the pages of a failed PDF behind
+        await pdf_pages.delete_many({"pdf_id": str(pdf_id)})
+        await pdfs.update_one({"_id": pdf_id}, {"$set": {"status": "failed", "error": str(e)}})
+
+async def store_pdf_pages(pdf_id: ObjectId, user_id: str, extracted: dict) -> dict | None:
+    """Store extracted pages, mark the PDF ready and embed its text"""
+    page_docs = [
+        PdfPage(pdf_id=str(pdf_id), user_id=user_id, page=number, content=text).model_dump()
+        for number, text in enumerate(extracted["pages"], start=1)
+    ]
+    # Pages are separate documents, so no PDF comes near Mongo's 16 MB document limit
+    if page_docs:
+        await pdf_pages.insert_many(page_docs)
+
+    update = {
+        "page_count": extracted["page_count"],
+        "stored_page_count": len(page_docs),
+        "truncated": extracted["truncated"],
+        "status": "ready"
+    }
+    # If no creation date in metadata, keep the upload time
+    if extracted["datetime"]:
+        update["datetime"] = extracted["datetime"]
+    pdf_doc = await pdfs.find_one_and_update(
+        {"_id": pdf_id},
+        {"$set": update},
+        return_document=ReturnDocument.AFTER
+    )
+    # Embed page by page; every page's chunks point back to the PDF
+    if pdf_doc:
+        await index_documents("pdfs", [{**pdf_doc, "content": page["content"]} for page in page_docs])
+    return pdf_doc
+
+INTERRUPTED_ERROR = "Extraction was interrupted, please upload again"
+
+def processing_cutoff() -> datetime:
+    """PDFs uploaded before this and still processing were abandoned"""
+    return datetime.utcnow() - timedelta(seconds=PDF_PROCESSING_TIMEOUT_SECONDS)
+
+def is_abandoned(pdf_id: ObjectId) -> bool:
+    # The ObjectId records the upload time
+    return pdf_id.generation_time.replace(tzinfo=None) < processing_cutoff()
+
+async def recover_stale_pdfs():
+    """
+    Mark PDFs left processing by a restarted process as failed and remove their
+    upload files (called on app startup). Only uploads older than
+    PDF_PROCESSING_TIMEOUT_SECONDS are touched, so other running processes'
+    in-flight extractions are left alone.
+    """
+    result = await pdfs.update_many(
+        {"status": "processing", "_id": {"$lt": ObjectId.from_datetime(processing_cutoff())}},
+        {"$set": {"status": "failed", "error": INTERRUPTED_ERROR}}
+    )
+    if result.modified_count:
+        logger.warning(f"Marked {result.modified_count} interrupted PDF uploads as failed")
+
+    if os.path.isdir(PDF_UPLOAD_DIR):
+        for name in os.listdir(PDF_UPLOAD_DIR):
+            path = os.path.join(PDF_UPLOAD_DIR, name)
+            try:
+                if os.path.getmtime(path) < time.time() - PDF_PROCESSING_TIMEOUT_SECONDS:
+                    os.unlink(path)
+            except OSError:
+                pass
+
 @router.post("/upload-pdf")
 async def upload_pdf(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     current_user: dict = Depends(get_current_user)
 ):
-    """Upload a PDF file and save its content to MongoDB"""
+    """
+    Upload a PDF file. Text extraction runs in a background process, so this
+    returns right away; poll /pdfs/{pdf_id}/status until it is ready.
+    """
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="File must be a PDF")
     
+    path = await save_upload(file)
     try:
-        # Read the file content
-        content = await file.read()
-        # Extract text and metadata from PDF using pdfplumber
-        with pdfplumber.open(io.BytesIO(content)) as pdf:
-            text_content = ""
-            for page in pdf.pages:
-                text_content += page.extract_text()
-            
-            # Get creation date from metadata
-            metadata = pdf.metadata
-            creation_date = metadata.get('ModDate') if metadata else None
-            
-            # If no creation date in metadata, use current time
-            if not creation_date:
-                creation_date = datetime.now()
-            else:
-                # Parse the PDF date format (usually D:YYYYMMDDHHmmSS)
-                try:
-                    # Remove 'D:' prefix if present and parse the date
-                    date_str = creation_date.replace('D:', '')
-                    creation_date = datetime.strptime(date_str[:14], '%Y%m%d%H%M%S')
-                except:
-                    creation_date = datetime.now()
-        
-        # Create PDF document
-        pdf_doc = {
-            "filename": file.filename,
-            "title": file.filename.rsplit('.', 1)[0],  # Use filename without extension as title
-            "content": text_content,
-            "user_id": str(current_user["_id"]),
-            "datetime": creation_date
-        }
+        # Create the PDF document now; extraction fills in the text
+        pdf_doc = PDF(
+            filename=file.filename,
+            title=file.filename.rsplit('.', 1)[0],  # Use filename without extension as title
+            user_id=str(current_user["_id"]),
+            datetime=datetime.now(),
+            status="processing"
+        ).model_dump()
         
         # Save to MongoDB
         result = await pdfs.insert_one(pdf_doc)
-        
-        return {
-            "message": "PDF uploaded successfully",
-            "pdf_id": str(result.inserted_id),
-            "filename": file.filename,
-            "creation_date": creation_date.isoformat()
-        }
-        
     except Exception as e:
+        os.unlink(path)
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
+    # The task owns the temporary file from here and removes it when done
+    background_tasks.add_task(process_pdf, result.inserted_id, pdf_doc["user_id"], path)
+    return {
+        "message": "PDF uploaded, extracting text",
+        "pdf_id": str(result.inserted_id),
+        "filename": file.filename,
+        "status": pdf_doc["status"]
+    }
+
+@router.get("/{pdf_id}/status")
+async def get_pdf_status(
+    pdf_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Extraction status of an uploaded PDF"""
+    pdf = await pdfs.find_one(
+        {"_id": ObjectId(pdf_id), "user_id": str(current_user["_id"])},
+        {"status": 1, "page_count": 1, "stored_page_count": 1, "truncated": 1, "error": 1}
+    )
+    if not pdf:
+        raise HTTPException(status_code=404, detail="PDF not found")
+    if pdf.get("status") == "processing" and is_abandoned(pdf["_id"]):
+        pdf["status"] = "failed"
+        pdf["error"] = INTERRUPTED_ERROR
+        await pdfs.update_one({"_id": pdf["_id"], "status": "processing"}, {"$set": {"status": "failed", "error": INTERRUPTED_ERROR}})
+    return {
+        "pdf_id": pdf_id,
+        "status": pdf.get("status", "ready"),
+        "page_count": pdf.get("page_count"),
+        "stored_page_count": pdf.get("stored_page_count"),
+        "truncated": pdf.get("truncated", False),
+        "error": pdf.get("error")
+    }
+
 async def get_user_pdfs(
     current_user: dict = Depends(get_current_user),
-    skip: int = 0,
-    limit: int = 50
+    limit: int = 50,
+    cursor: str | None = None,
+    projection: dict | None = None,
+    include_total: bool = False
 ):
-    """Get user's PDFs with pagination"""
+    """
+    Get a page of the user's PDFs, newest first, with keyset pagination on
+    (datetime, _id): pass the returned next_cursor to get the following page.
+    """
     user_id = str(current_user["_id"])
-    
-    # Get total count
-    total = await pdfs.count_documents({"user_id": user_id})
-    
-    # Get PDFs with pagination
-    cursor = pdfs.find({"user_id": user_id})
-    cursor = cursor.sort("filename", 1)  # Sort by filename ascending
-    cursor = cursor.skip(skip).limit(limit)
-    
-    pdf_list = await cursor.to_list(None)
-    
-    return {
-        "total": total,
-        "skip": skip,
-        "limit": limit,
-        "pdfs": pdf_list
-    }
+    page = await paginate(pdfs, {"user_id": user_id}, "datetime", -1, limit, cursor, projection, include_total)
+    page["pdfs"] = page.pop("items")
+    return page
+
+@router.get("")
+async def list_pdfs(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = None,
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """List the user's PDFs without their text; fetch one by ID for its content"""
+    try:
+        return await get_user_pdfs(
+            current_user,
+            limit=limit,
+            cursor=cursor,
+            projection=LIST_PROJECTION,
+            include_total=include_total
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/count")
 async def count_pdfs(current_user: dict = Depends(get_current_user)):
@@ -104,9 +312,14 @@ async def count_pdfs(current_user: dict = Depends(get_current_user)):
 @router.get("/{pdf_id}")
 async def get_pdf(
     pdf_id: str,
+    page_start: int = Query(1, ge=1),
+    page_limit: int = Query(10, ge=1, le=PDF_PAGE_RANGE_LIMIT),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get a specific PDF by ID"""
+    """
+    Get a specific PDF's metadata and the text of a range of its pages
+    (page_start is 1-based). Use next_page_start to read further.
+    """
     user_id = current_user["_id"]
     
     pdf = await pdfs.find_one({
@@ -120,4 +333,14 @@ async def get_pdf(
     # Convert ObjectId to string before returning
     pdf["_id"] = str(pdf["_id"])
     
-    return pdf
\ No newline at end of file
+    page_list = await pdf_pages.find(
+        {"pdf_id": pdf_id, "page": {"$gte": page_start}},
+        {"_id": 0, "page": 1, "content": 1}
+    ).sort("page", 1).limit(page_limit).to_list(None)
+    pdf["pages"] = page_list
+    last_page = page_list[-1]["page"] if page_list else 0
+    # A truncated PDF has text for fewer pages than it has; PDFs stored before the count was kept fall back to page_count
+    stored_pages = pdf.get("stored_page_count", pdf.get("page_count")) or 0
+    pdf["next_page_start"] = last_page + 1 if page_list and last_page < stored_pages else None
+    
+    return pdf
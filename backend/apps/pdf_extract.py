@@ -0,0 +1,45 @@
+"""
+PDF text extraction, run in worker processes so it never blocks the event loop.
+Keep this module free of database and web imports: every pool process imports it.
+"""
+from datetime import datetime
+import pdfplumber
+
+def parse_pdf_date(value) -> datetime | None:
+    """Parse a PDF metadata date (usually D:YYYYMMDDHHmmSS)"""
+    if not value:
+        return None
+    try:
+        # Remove 'D:' prefix if present and parse the date
+        return datetime.strptime(str(value).replace('D:', '')[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+
+def extract_pdf(path: str, max_chars: int) -> dict:
+    """
+    Extract the per-page text, page count and modification date of a PDF file.
+    Pages are read one at a time and released, and extraction stops once
+    max_chars of text have been collected.
+    """
+    with pdfplumber.open(path) as pdf:
+        pages = []
+        total_chars = 0
+        truncated = False
+        for page in pdf.pages:
+            # Scanned pages have no text layer and return None
+            text = page.extract_text() or ""
+            page.close()
+            if total_chars + len(text) > max_chars:
+                pages.append(text[:max_chars - total_chars])
+                truncated = True
+                break
+            pages.append(text)
+            total_chars += len(text)
+
+        metadata = pdf.metadata
+        return {
+            "pages": pages,
+            "page_count": len(pdf.pages),
+            "truncated": truncated,
+            "datetime": parse_pdf_date(metadata.get('ModDate') if metadata else None)
+        }
@@ -1,15 +1,49 @@
-from .db import users
+from .db import init_db, users
 from .email import sync_emails
 from .events import sync_events
-from .ai import generate_nodes
-from datetime import datetime, timedelta
+from .ai import generate_nodes, save_nodes
+from .jobs import enqueue_job
+from .auth import invalidate_user
+from datetime import datetime, timedelta, timezone
+import asyncio
+import hashlib
 import logging
+import os
+import time
 from bson.objectid import ObjectId
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Periodic sync configuration
+SYNC_INTERVAL_SECONDS = int(os.getenv("SYNC_INTERVAL_SECONDS", str(6 * 60 * 60)))
+SCHEDULER_TICK_SECONDS = int(os.getenv("SCHEDULER_TICK_SECONDS", "60"))
+# Users synced more recently than this (e.g. by hand) are skipped at their slot
+SYNC_FRESHNESS_SECONDS = int(os.getenv("SYNC_FRESHNESS_SECONDS", str(SYNC_INTERVAL_SECONDS // 2)))
+
+async def run_stage_graph(stages: dict, sync_results: dict):
+    """
+    Run sync stages as a small dependency graph. stages maps a stage name to
+    (dependency names, async callable) and must list dependencies first. Each stage
+    starts as soon as its dependencies finish, so independent stages run
+    concurrently. Wall-clock seconds per stage are recorded in sync_results["timings"].
+    """
+    tasks = {}
+    timings = sync_results.setdefault("timings", {})
+
+    async def run(name, dependencies, stage):
+        await asyncio.gather(*(tasks[dependency] for dependency in dependencies))
+        started = time.perf_counter()
+        try:
+            await stage()
+        finally:
+            timings[name] = round(time.perf_counter() - started, 3)
+
+    for name, (dependencies, stage) in stages.items():
+        tasks[name] = asyncio.create_task(run(name, dependencies, stage))
+    await asyncio.gather(*tasks.values())
+
 async def sync_user_data(user_id: str, access_token: str):
     """Sync all data for a specific user"""
     logger.info(f"Starting sync for user {user_id}")
@@ -20,61 +54,136 @@ async def sync_user_data(user_id: str, access_token: str):
             "events": 0,
             "status": "success"
         }
+        started = time.perf_counter()
         
         # Sync emails
-        try:
-            logger.info(f"Starting email sync for user {user_id}")
-            # sync_results["emails"] = await sync_emails(access_token, user_id, 100)
-            # logger.info(f"Completed email sync: {sync_results['emails']} emails")
-        except Exception as e:
-            sync_results["status"] = "partial"
-            sync_results["email_error"] = str(e)
-            logger.error(f"Error syncing emails for user {user_id}: {str(e)}")
+        async def email_stage():
+            try:
+                logger.info(f"Starting email sync for user {user_id}")
+                sync_results["emails"] = await sync_emails(access_token, user_id, 100)
+                logger.info(f"Completed email sync: {sync_results['emails']} emails")
+            except Exception as e:
+                sync_results["status"] = "partial"
+                sync_results["email_error"] = str(e)
+                logger.error(f"Error syncing emails for user {user_id}: {str(e)}")
         
         # Sync calendar events
-        try:
-            logger.info(f"Starting event sync for user {user_id}")
-            # Get events from previous month to 5 days ahead
-            now = datetime.utcnow()
-            start_time = (now - timedelta(days=30)).isoformat() + "Z"  # Previous month
-            end_time = (now + timedelta(days=5)).isoformat() + "Z"     # 5 days ahead
-            sync_results["events"] = await sync_events(access_token, user_id, start_time, end_time)
-            logger.info(f"Completed event sync: {sync_results['events']} events")
-        except Exception as e:
-            sync_results["status"] = "partial"
-            sync_results["event_error"] = str(e)
-            logger.error(f"Error syncing events for user {user_id}: {str(e)}")
+        async def event_stage():
+            try:
+                logger.info(f"Starting event sync for user {user_id}")
+                # Get events from previous month to 5 days ahead
+                now = datetime.utcnow()
+                start_time = (now - timedelta(days=30)).isoformat() + "Z"  # Previous month
+                end_time = (now + timedelta(days=5)).isoformat() + "Z"     # 5 days ahead
+                sync_results["events"] = await sync_events(access_token, user_id, start_time, end_time)
+                logger.info(f"Completed event sync: {sync_results['events']} events")
+            except Exception as e:
+                sync_results["status"] = "partial"
+                sync_results["event_error"] = str(e)
+                logger.error(f"Error syncing events for user {user_id}: {str(e)}")
         
         # Generate nodes with AI
-        try:
-            logger.info(f"Starting AI processing for user {user_id}")
-            # Get user document for AI processing
-            current_user = await users.find_one({"_id": ObjectId(user_id)})
-            if not current_user:
-                raise Exception("User not found")
+        async def ai_stage():
+            try:
+                logger.info(f"Starting AI processing for user {user_id}")
+                # Get user document for AI processing
+                # Credentials aren't needed here and must not travel into logs
+                current_user = await users.find_one(
+                    {"_id": ObjectId(user_id)},
+                    {"google_token": 0, "google_refresh_token": 0}
+                )
+                if not current_user:
+                    raise Exception("User not found")
+                    
+                # Raises on failure, so a bad generation never overwrites nodes_tmp
+                nodes_data, watermark = await generate_nodes(current_user)
                 
-            nodes_data = await generate_nodes(current_user)
-            
-            # Count total nodes
-            total_nodes = len(nodes_data)
-            
-            sync_results["ai_nodes"] = total_nodes
-            # Update user's nodes_tmp field with the generated nodes
-            await users.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$set": {"nodes_tmp": nodes_data}}
-            )
-            
-            logger.info(f"AI processing complete: {total_nodes} nodes generated")
-            
-        except Exception as e:
-            sync_results["status"] = "partial" 
-            sync_results["ai_error"] = str(e)
-            logger.error(f"Error in AI processing for user {user_id}: {str(e)}")
+                # Count total nodes
+                total_nodes = len(nodes_data)
+                
+                sync_results["ai_nodes"] = total_nodes
+                # Update user's nodes_tmp field with the generated nodes, then the watermark
+                await save_nodes(user_id, nodes_data, watermark)
+                
+                logger.info(f"AI processing complete: {total_nodes} nodes generated")
+                
+            except Exception as e:
+                sync_results["status"] = "partial" 
+                sync_results["ai_error"] = str(e)
+                logger.error(f"Error in AI processing for user {user_id}: {str(e)}")
+
+        # Email and calendar ingestion are independent; AI waits for both
+        await run_stage_graph({
+            "emails": ((), email_stage),
+            "events": ((), event_stage),
+            "ai": (("emails", "events"), ai_stage),
+        }, sync_results)
+        sync_results["timings"]["total"] = round(time.perf_counter() - started, 3)
         
+        await users.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$set": {"last_synced_at": datetime.utcnow()}}
+        )
+        invalidate_user(user_id)
         logger.info(f"Completed sync for user {user_id}: {sync_results}")
         return sync_results
         
     except Exception as e:
         logger.error(f"Error in sync_user_data for user {user_id}: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
+
+def sync_slot(user_id: str, interval: int = SYNC_INTERVAL_SECONDS) -> int:
+    """Stable offset (in seconds) of a user's sync within each interval, spreading users evenly"""
+    digest = hashlib.sha256(user_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % interval
+
+def is_due(user_id: str, window_start: datetime, window_seconds: int, interval: int = SYNC_INTERVAL_SECONDS) -> bool:
+    """Whether the user's slot falls inside the window starting at window_start (naive UTC)"""
+    phase = int(window_start.replace(tzinfo=timezone.utc).timestamp()) % interval
+    return (sync_slot(user_id, interval) - phase) % interval < window_seconds
+
+async def schedule_due_users(window_start: datetime, window_seconds: int = SCHEDULER_TICK_SECONDS) -> int:
+    """Queue sync jobs for users whose slot is in the given window and whose data is stale"""
+    fresh_after = datetime.utcnow() - timedelta(seconds=SYNC_FRESHNESS_SECONDS)
+    queued = 0
+
+    cursor = users.find(
+        {"google_token": {"$ne": None}},
+        {"_id": 1, "last_synced_at": 1}
+    )
+    async for user in cursor:
+        user_id = str(user["_id"])
+        if not is_due(user_id, window_start, window_seconds):
+            continue
+        last_synced_at = user.get("last_synced_at")
+        if last_synced_at and last_synced_at > fresh_after:
+            continue
+        await enqueue_job("sync_user_data", user_id)
+        queued += 1
+
+    if queued:
+        logger.info(f"Scheduled {queued} user syncs")
+    return queued
+
+async def run_scheduler():
+    """
+    Re-sync every user once per SYNC_INTERVAL_SECONDS. Each user gets a fixed
+    hash-based slot in the interval, so load is spread evenly instead of every
+    user syncing at once. Run a single instance: python -m apps.scheduler
+    """
+    await init_db()
+    logger.info(f"Scheduler starting: interval={SYNC_INTERVAL_SECONDS}s tick={SCHEDULER_TICK_SECONDS}s")
+    window_start = datetime.utcnow()
+    while True:
+        await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+        # Windows are contiguous, so a slow tick never skips anyone's slot
+        now = datetime.utcnow()
+        window_seconds = min(int((now - window_start).total_seconds()), SYNC_INTERVAL_SECONDS)
+        try:
+            await schedule_due_users(window_start, window_seconds)
+        except Exception as e:
+            logger.error(f"Error scheduling user syncs: {e}")
+        window_start += timedelta(seconds=window_seconds)
+
+if __name__ == "__main__":
+    asyncio.run(run_scheduler())
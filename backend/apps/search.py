@@ -0,0 +1,142 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from bson import ObjectId
+import asyncio
+import html
+import re
+from .db import emails, calendars, pdfs, pdf_pages
+from .auth import get_current_user
+from .context import clean_email_body, strip_html
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"]
+)
+
+SNIPPET_CHARS = 160
+
+# Per content kind: collection, fields returned in hits, field the snippet is cut from.
+# PDF text lives in pdf_pages (see search_pdf_pages); pdfs matches titles and older PDFs
+SEARCH_SOURCES = {
+    "emails": (emails, ("subject", "sender", "datetime"), "content"),
+    "calendars": (calendars, ("event_name", "datetime_start", "location"), "description"),
+    "pdfs": (pdfs, ("title", "filename", "datetime"), "content"),
+}
+
+def query_terms(q: str) -> list:
+    """Words and quoted phrases in a search query, as MongoDB's $text parses them"""
+    phrases = re.findall(r'"([^"]+)"', q)
+    words = re.sub(r'"[^"]*"', " ", q).split()
+    return [term for term in phrases + words if not term.startswith("-")]
+
+def make_snippet(text: str | None, terms: list, length: int = SNIPPET_CHARS) -> str:
+    """Cut a window of text around the first matching term and wrap matches in <mark>"""
+    if not text:
+        return ""
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE) if terms else None
+    match = pattern.search(text) if pattern else None
+    start = max(match.start() - length // 3, 0) if match else 0
+    window = text[start:start + length]
+
+    snippet = ""
+    last = 0
+    for found in pattern.finditer(window) if pattern else ():
+        snippet += html.escape(window[last:found.start()]) + f"<mark>{html.escape(found.group())}</mark>"
+        last = found.end()
+    snippet += html.escape(window[last:])
+    snippet = " ".join(snippet.split())
+    return ("…" if start > 0 else "") + snippet + ("…" if start + length < len(text) else "")
+
+def snippet_text(kind: str, text: str | None) -> str:
+    """Readable text to cut snippets from; email bodies and event descriptions may be HTML"""
+    if kind == "emails":
+        return clean_email_body(text)
+    return strip_html(text or "")
+
+async def search_kind(kind: str, user_id: str, q: str, terms: list, limit: int) -> list:
+    """Ranked text-index search over one collection, scoped to the user"""
+    collection, fields, snippet_field = SEARCH_SOURCES[kind]
+    projection = {field: 1 for field in fields + (snippet_field,)}
+    projection["score"] = {"$meta": "textScore"}
+
+    # The user_id prefix on the text index keeps this to the user's own documents
+    cursor = collection.find({"user_id": user_id, "$text": {"$search": q}}, projection)
+    cursor = cursor.sort([("score", {"$meta": "textScore"})]).limit(limit)
+
+    hits = []
+    async for document in cursor:
+        hit = {field: document.get(field) for field in fields}
+        hit.update({
+            "_id": str(document["_id"]),
+            "kind": kind,
+            "score": document["score"],
+            "snippet": make_snippet(snippet_text(kind, document.get(snippet_field)), terms)
+        })
+        hits.append(hit)
+    return hits
+
+async def search_pdf_pages(user_id: str, q: str, terms: list, limit: int) -> list:
+    """Ranked search over PDF page text, one hit per PDF for its best-matching page"""
+    projection = {"pdf_id": 1, "page": 1, "content": 1, "score": {"$meta": "textScore"}}
+    cursor = pdf_pages.find({"user_id": user_id, "$text": {"$search": q}}, projection)
+    cursor = cursor.sort([("score", {"$meta": "textScore"})]).limit(limit)
+
+    best_pages = {}
+    async for page in cursor:
+        best_pages.setdefault(page["pdf_id"], page)
+    if not best_pages:
+        return []
+
+    headers = {}
+    async for header in pdfs.find(
+        {"_id": {"$in": [ObjectId(pdf_id) for pdf_id in best_pages]}},
+        {"title": 1, "filename": 1, "datetime": 1}
+    ):
+        headers[str(header["_id"])] = header
+
+    hits = []
+    for pdf_id, page in best_pages.items():
+        header = headers.get(pdf_id)
+        if not header:
+            continue
+        hits.append({
+            "title": header.get("title"),
+            "filename": header.get("filename"),
+            "datetime": header.get("datetime"),
+            "_id": pdf_id,
+            "kind": "pdfs",
+            "page": page["page"],
+            "score": page["score"],
+            "snippet": make_snippet(page.get("content"), terms)
+        })
+    return hits
+
+@router.get("")
+async def search(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    kinds: list[str] = Query(list(SEARCH_SOURCES)),
+    current_user: dict = Depends(get_current_user)
+):
+    """Full-text search across the user's emails, events and PDFs, best matches first"""
+    unknown = set(kinds) - set(SEARCH_SOURCES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown kinds: {', '.join(sorted(unknown))}")
+
+    user_id = str(current_user["_id"])
+    terms = query_terms(q)
+    searches = [search_kind(kind, user_id, q, terms, limit) for kind in kinds]
+    if "pdfs" in kinds:
+        searches.append(search_pdf_pages(user_id, q, terms, limit))
+    results = await asyncio.gather(*searches)
+
+    # A PDF can match on its title and on its pages; keep its best hit
+    hits = []
+    seen = set()
+    for hit in sorted((hit for kind_hits in results for hit in kind_hits), key=lambda hit: hit["score"], reverse=True):
+        if (hit["kind"], hit["_id"]) not in seen:
+            seen.add((hit["kind"], hit["_id"]))
+            hits.append(hit)
+    return {
+        "query": q,
+        "hits": hits[:limit]
+    }
@@ -1,7 +1,6 @@
-from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.responses import RedirectResponse
-import requests
 from dotenv import load_dotenv
 load_dotenv()
 import os
@@ -12,11 +11,14 @@ from datetime import datetime, timedelta
 from bson import ObjectId
 from .db import init_db, users, nodes, branches, User, Node, Branch
 from .email import router as email_router, sync_emails
-from .pdf import router as pdf_router
-from .scheduler import sync_user_data
-from .auth import get_current_user, create_access_token, oauth2_scheme
+from .pdf import router as pdf_router, shutdown_extract_pool, recover_stale_pdfs
+from .jobs import router as jobs_router, enqueue_job
+from .search import router as search_router
+from .auth import get_current_user, create_access_token, oauth2_scheme, invalidate_user, load_user_fields
 from .events import router as events_router
-from .ai import generate_nodes
+from .ai import generate_nodes, get_cache_stats, NodeGenerationError
+from .google_api import close_http_client
+from .google_auth import exchange_code, fetch_user_info, token_fields, GoogleAuthError
 import logging
 
 # Configure logging
@@ -32,6 +34,12 @@ app = FastAPI()
 @app.on_event("startup")
 async def startup_event():
     await init_db()
+    await recover_stale_pdfs()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    shutdown_extract_pool()
 
 # Add CORS middleware
 app.add_middleware(
@@ -46,6 +54,8 @@ app.add_middleware(
 app.include_router(email_router)
 app.include_router(pdf_router)
 app.include_router(events_router)
+app.include_router(jobs_router)
+app.include_router(search_router)
 
 # Replace these with your own values from the Google Developer Console
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
@@ -55,27 +65,17 @@ GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
 @app.get("/login/google")
 async def login_google():
     return RedirectResponse(
-        f"https://accounts.google.com/o/oauth2/auth?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email%20https://www.googleapis.com/auth/gmail.readonly%20https://www.googleapis.com/auth/calendar.readonly&access_type=offline"
+        f"https://accounts.google.com/o/oauth2/auth?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email%20https://www.googleapis.com/auth/gmail.readonly%20https://www.googleapis.com/auth/calendar.readonly&access_type=offline&prompt=consent"
     )
 
 @app.get("/auth/google")
 async def auth_google(code: str):
-    token_url = "https://accounts.google.com/o/oauth2/token"
-    data = {
-        "code": code,
-        "client_id": GOOGLE_CLIENT_ID,
-        "client_secret": GOOGLE_CLIENT_SECRET,
-        "redirect_uri": GOOGLE_REDIRECT_URI,
-        "grant_type": "authorization_code",
-    }
-    response = requests.post(token_url, data=data)
-    token_data = response.json()
-    access_token = token_data.get("access_token")
-    refresh_token = token_data.get("refresh_token")
-    print(token_data)
-    
-    user_info = requests.get("https://www.googleapis.com/oauth2/v1/userinfo", headers={"Authorization": f"Bearer {access_token}"})
-    user_data = user_info.json()
+    try:
+        token_data = await exchange_code(code)
+        user_data = await fetch_user_info(token_data["access_token"])
+    except GoogleAuthError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tokens = token_fields(token_data)
     
     # Check if user exists in database
     existing_user = await users.find_one({"email": user_data.get("email")})
@@ -86,19 +86,20 @@ async def auth_google(code: str):
             {"email": user_data.get("email")},
             {
                 "$set": {
-                    "google_token": access_token,
+                    **tokens,
                     "google_data": user_data
                 }
             }
         )
         user_id = str(existing_user["_id"])
+        invalidate_user(user_id)
     else:
         # Create new user
         new_user = User(
             name=user_data.get("name"),
             email=user_data.get("email"),
             google_data=user_data,
-            google_token=access_token
+            **tokens
         )
         result = await users.insert_one(new_user.model_dump())
         user_id = str(result.inserted_id)
@@ -122,32 +123,50 @@ async def get_token(token: str = Depends(oauth2_scheme)):
 
 @app.get("/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
-    return current_user
+    # The frontend shows google_data.picture, which cached user records leave out
+    return await load_user_fields(current_user, ("google_data",))
 
 @app.get("/begin-ai")
-async def start(background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
-    """Start a sync process for the current user"""
+async def start(current_user: dict = Depends(get_current_user)):
+    """Queue a sync process for the current user (run by apps.worker)"""
     if not current_user.get("google_token"):
         raise HTTPException(status_code=400, detail="No Google token found. Please login with Google first.")
     
-    # Add sync task to background tasks
-    background_tasks.add_task(sync_user_data, current_user["_id"], current_user["google_token"])
+    # Returns the already-running job if the user has one in flight
+    job = await enqueue_job("sync_user_data", current_user["_id"])
     
     return {
         "message": "Sync process started",
-        "status": "processing"
+        "status": "processing",
+        "job_id": str(job["_id"]),
+        "job_status": job["status"]
     }
 
 @app.get("/generate-ai-nodes")
 async def generate_ai_nodes(current_user: dict = Depends(get_current_user)):
     """Generate a list of nodes using AI based on user's data"""
     try:
-        result = await generate_nodes(current_user)
+        current_user = await load_user_fields(current_user, ("nodes_tmp",))
+        # Nodes are returned, not stored, so the incremental watermark stays put
+        result, _ = await generate_nodes(current_user)
         return result
+    except NodeGenerationError as e:
+        logger.error(f"AI node generation failed: {e}")
+        raise HTTPException(status_code=502, detail=f"AI node generation failed: {str(e)}")
     except Exception as e:
         logger.error(f"Error generating AI nodes: {e}")
         raise HTTPException(status_code=500, detail=f"Error generating AI nodes: {str(e)}")
 
+@app.get("/ai/cache-stats")
+async def get_ai_cache_stats(current_user: dict = Depends(get_current_user)):
+    """AI response cache hit/miss counters, summed over the server and the workers"""
+    cache_stats = await get_cache_stats()
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        **cache_stats,
+        "hit_rate": cache_stats["hits"] / lookups if lookups else None
+    }
+
 @app.get("/protected")
 async def protected_route(current_user: dict = Depends(get_current_user)):
     return {
@@ -160,6 +179,7 @@ async def get_nodes(current_user: dict = Depends(get_current_user)):
     # Get all branches for the user
     
     # Get all nodes for the user
+    current_user = await load_user_fields(current_user, ("nodes_tmp",))
     nodes_list = current_user.get("nodes_tmp", [])
     return str(nodes_list)
 
@@ -195,7 +215,7 @@ async def add_node(node_data: dict, current_user: dict = Depends(get_current_use
 
 @app.get("/users")
 async def get_users():
-    users_list = await users.find().to_list(None)
+    users_list = await users.find({}, {"google_token": 0, "google_refresh_token": 0}).to_list(None)
     for user in users_list:
         user["_id"] = str(user["_id"])
     return users_list
@@ -0,0 +1,96 @@
+"""
+Background worker that runs queued jobs outside the web process.
+
+Run one or more of these alongside the API:
+    python -m apps.worker
+"""
+import asyncio
+import os
+import socket
+import uuid
+from logging import getLogger
+from .db import init_db
+from .jobs import claim_job, complete_job, fail_job, renew_lease, JOB_HEARTBEAT_SECONDS
+from .scheduler import sync_user_data
+from .google_api import close_http_client
+from .google_auth import get_valid_access_token
+
+logger = getLogger(__name__)
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "2"))
+
+async def run_sync_user_data(job: dict) -> dict:
+    """Run a full data sync for the job's user"""
+    # Refreshed ahead of expiry, so background syncs never start with a dead token
+    access_token = await get_valid_access_token(job["user_id"])
+    sync_results = await sync_user_data(job["user_id"], access_token)
+    # Stages catch their own errors; a partial sync is retried with backoff like any failure
+    if sync_results["status"] != "success":
+        errors = {key: value for key, value in sync_results.items() if key.endswith("_error")}
+        raise Exception(f"Sync {sync_results['status']}: {errors}")
+    return sync_results
+
+JOB_HANDLERS = {
+    "sync_user_data": run_sync_user_data,
+}
+
+async def heartbeat(job: dict):
+    """Keep renewing the job's lease so a long run is not reclaimed by another worker"""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            if not await renew_lease(job):
+                logger.warning(f"Job {job['_id']} is no longer leased to this worker")
+                return
+        except Exception as e:
+            logger.error(f"Error renewing lease for job {job['_id']}: {e}")
+
+async def run_job(job: dict):
+    """Run a claimed job and record its outcome"""
+    if job["attempts"] > job.get("max_attempts", 0):
+        # Reclaimed after its worker died on the final attempt
+        await fail_job(job, job.get("error") or "Worker lease expired")
+        return
+
+    handler = JOB_HANDLERS.get(job["kind"])
+    if handler is None:
+        await fail_job(job, f"Unknown job kind: {job['kind']}")
+        return
+
+    logger.info(f"Running job {job['_id']} ({job['kind']}) for user {job['user_id']}, attempt {job['attempts']}")
+    lease = asyncio.create_task(heartbeat(job))
+    try:
+        result = await handler(job)
+    except Exception as e:
+        await fail_job(job, str(e))
+    else:
+        await complete_job(job, result)
+    finally:
+        lease.cancel()
+
+async def worker_loop(worker_id: str):
+    """Claim and run jobs one at a time, polling when the queue is empty"""
+    while True:
+        try:
+            job = await claim_job(worker_id)
+        except Exception as e:
+            logger.error(f"Error claiming job: {e}")
+            job = None
+
+        if job is None:
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+            continue
+        await run_job(job)
+
+async def main():
+    await init_db()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    logger.info(f"Worker {worker_id} starting with concurrency {WORKER_CONCURRENCY}")
+    try:
+        await asyncio.gather(*(worker_loop(worker_id) for _ in range(WORKER_CONCURRENCY)))
+    finally:
+        await close_http_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
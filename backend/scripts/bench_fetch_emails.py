@@ -0,0 +1,150 @@
+"""Benchmark Gmail message fetching against a local fake Gmail server.
+
+Usage (from the backend directory):
+    python scripts/bench_fetch_emails.py --messages 200 --latency 0.05
+    python scripts/bench_fetch_emails.py --messages 2000 --batch
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_message(index: int) -> dict:
+    body = base64.urlsafe_b64encode(f"Fake message body {index}".encode()).decode()
+    return {
+        "id": f"msg{index:06d}",
+        "labelIds": ["INBOX"],
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "From", "value": f"sender{index % 17}@example.com"},
+                {"name": "Subject", "value": f"Subject {index}"},
+                {"name": "Date", "value": "Mon, 07 Apr 2025 10:00:00 +0000"},
+            ],
+            "body": {"data": body},
+        },
+    }
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    """Serves messages.list, messages.get and batch requests with an artificial per-request latency"""
+    total_messages = 0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith("/users/me/messages"):
+            start = int(query.get("pageToken", ["0"])[0])
+            size = int(query.get("maxResults", ["100"])[0])
+            end = min(start + size, self.total_messages)
+            data = {"messages": [{"id": f"msg{i:06d}"} for i in range(start, end)]}
+            if end < self.total_messages:
+                data["nextPageToken"] = str(end)
+            self.send_json(data)
+        elif "/users/me/messages/" in url.path:
+            index = int(url.path.rsplit("/", 1)[1].removeprefix("msg"))
+            self.send_json(make_message(index))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        if not self.path.startswith("/batch/gmail/v1"):
+            self.send_error(404)
+            return
+
+        boundary = re.search(r"boundary=([^;]+)", self.headers["Content-Type"]).group(1)
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        response_boundary = "batch_response"
+        parts = []
+        for part in body.split(f"--{boundary}"):
+            content_id = re.search(r"Content-ID: <([^>]+)>", part)
+            request_line = re.search(r"GET (\S+)", part)
+            if not content_id or not request_line:
+                continue
+            index = int(request_line.group(1).rsplit("/", 1)[1].removeprefix("msg"))
+            parts.append(
+                f"--{response_boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id.group(1)}>\r\n"
+                "\r\n"
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n"
+                "\r\n"
+                f"{json.dumps(make_message(index))}\r\n"
+            )
+        payload = ("".join(parts) + f"--{response_boundary}--\r\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/mixed; boundary={response_boundary}")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(total_messages: int, latency: float) -> ThreadingHTTPServer:
+    FakeGmailHandler.total_messages = total_messages
+    FakeGmailHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGmailHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run(number: int, concurrency_levels: list[int], batch: bool):
+    from apps.fetch_emails import get_recent_emails
+    from apps.google_api import close_http_client
+
+    for concurrency in concurrency_levels:
+        started = time.perf_counter()
+        fetched = await get_recent_emails(
+            "fake-token", "bench-user", number, concurrency=concurrency, batch=batch, skip_known=False
+        )
+        elapsed = time.perf_counter() - started
+        print(f"batch={batch!s:<5}  concurrency={concurrency:>3}  messages={len(fetched):>5}  "
+              f"elapsed={elapsed:6.2f}s  throughput={len(fetched) / elapsed:8.1f} msg/s")
+    await close_http_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated per-request latency in seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 25])
+    parser.add_argument("--batch", action="store_true", help="Hydrate messages with batch requests")
+    args = parser.parse_args()
+
+    server = start_server(args.messages, args.latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["GMAIL_API_BASE"] = f"{base}/gmail/v1"
+    os.environ["GMAIL_BATCH_URL"] = f"{base}/batch/gmail/v1"
+    try:
+        asyncio.run(run(args.messages, args.concurrency, args.batch))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()